@@ -1,17 +1,16 @@
-import os
-import logging
 from flask import Flask, request
 from config import Config
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
-from logging.handlers import SMTPHandler, RotatingFileHandler
 from elasticsearch import Elasticsearch
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.cache import make_cache
+from app.replicas import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()  # Flask-SQLAlchemy, with reads in GET requests sent to the replicas
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'  # set view function to auth.login function
@@ -23,8 +22,14 @@ moment = Moment()
 def create_app(config_class=Config):  # creates flask application instance
     app = Flask(__name__)
     app.config.from_object(config_class)
+    if app.config['PROXY_FIX_X_FOR']:  # behind a router every request comes from the router's address
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'],
+                                x_proto=app.config['PROXY_FIX_X_FOR'])
 
     db.init_app(app)
+    if app.config['SQLITE_TUNED']:  # WAL and a per-process writer lock for SQLite databases
+        from app import sqlite
+        sqlite.init_app(app, db)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
@@ -32,6 +37,37 @@ def create_app(config_class=Config):  # creates flask application instance
     moment.init_app(app)
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None  # create elasticsearch instance in global scope, sets it to None if URL isn't defined
+    app.search_cache = make_cache(app.config['SEARCH_CACHE_URL'], 'search:',
+                                  app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'])  # caches pages of search results
+    app.fragment_cache = make_cache(app.config['FRAGMENT_CACHE_URL'], 'fragment:', app.config['FRAGMENT_CACHE_SIZE'],
+                                    app.config['FRAGMENT_CACHE_TTL'])  # caches rendered post rows
+    app.user_cache = make_cache(app.config['USER_CACHE_URL'], 'user:', app.config['USER_CACHE_SIZE'],
+                                app.config['USER_CACHE_TTL'])  # column values of logged in users, see load_user
+
+    from app.fragments import render_post, template_version
+    app.add_template_global(render_post)  # used by _post.html
+    app.fragment_version = template_version(app)  # part of every fragment cache key
+
+    from app.recent import RecentPosts
+    app.recent_posts = RecentPosts(app)  # newest posts for /explore, filled by session hooks
+    app.before_first_request(app.recent_posts.warm)
+
+    from app.presence import LastSeenTracker
+    app.presence = LastSeenTracker(app)  # buffers last_seen updates, see main.before_request
+
+    from app.passwords import PasswordHasher, LoginRateLimiter
+    app.passwords = PasswordHasher(app)  # hashes and verifies passwords, see User.set_password
+    app.login_limiter = LoginRateLimiter(app)  # throttles login attempts before any hashing
+
+    from app.emails import MailQueue
+    app.mailer = MailQueue(app)  # worker pool sending mail off the request thread
+
+    from app.indexer import SearchIndexer
+    app.indexer = SearchIndexer(app)  # background workers that send queued changes to the search index
+
+    if app.config['INSTRUMENTATION_ENABLED']:
+        from app.instrumentation import Instrumentation
+        app.instrumentation = Instrumentation(app)  # per-request timings, Server-Timing header and /metrics
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)  # connects all error handlers, view functions to application
@@ -43,23 +79,8 @@ def create_app(config_class=Config):  # creates flask application instance
     app.register_blueprint(main_bp)
 
     if not app.debug and not app.testing:  # only send logs when debug and testing mode is off
-        if app.config['LOG_TO_STDOUT']:  # logs to stdout if setup in config
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
-        else:
-            # logging to files
-            if not os.path.exists('logs'):
-                os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/microblog.log',
-                                               maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter(
-                '%(asctime)s %(levelname)s: %(message)s '
-                '[in %(pathname)s:%(lineno)d]'))
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
+        from app.logs import LogPipeline
+        app.log_pipeline = LogPipeline(app)  # JSON lines written by a background thread
         app.logger.info('Microblog startup')
 
     return app
@@ -1,5 +1,5 @@
 # auth/routes.py: Handles AUTHENTIFICATION RELATED routing
-from flask import render_template, flash, redirect, url_for, request
+from flask import render_template, flash, redirect, url_for, request, current_app
 from flask_login import current_user, login_user, logout_user
 from app import db
 from app.auth import bp
@@ -7,6 +7,7 @@ from app.auth.forms import LoginForm, RegistrationForm, \
     ResetPasswordRequestForm, ResetPasswordForm
 from app.auth.emails import send_password_reset_email
 from app.models import User
+from app.passwords import PasswordHasherBusy
 from werkzeug.urls import url_parse
 
 @bp.route('/login', methods=['GET', 'POST'])  # GET requests(server->client), POST requests(client->server)
@@ -15,10 +16,20 @@ def login():
         return redirect(url_for('main.index'))  # just redirects them to index
     form = LoginForm()
     if form.validate_on_submit():  # run below if they press submit (POST)
+        # throttled per username and address before any password hashing happens
+        if not current_app.login_limiter.allow(form.username.data, request.remote_addr):
+            flash('Too many login attempts. Please try again later.')
+            return render_template('auth/login.html', title='Sign In', form=form), 429
         user = User.query.filter_by(username=form.username.data).first()  # use .first() because only want one result
-        if user is None or user.check_password(form.password.data) == False:  # if username field is empty or password doesn't match
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+        except PasswordHasherBusy:
+            flash('The server is busy. Please try again in a moment.')
+            return render_template('auth/login.html', title='Sign In', form=form), 503
+        if not valid:  # if username field is empty or password doesn't match
             flash('Invalid username or password.')
             return redirect(url_for('auth.login'))
+        db.session.commit()  # saves the upgraded hash if check_password rehashed it
         login_user(user, remember=form.remember_me.data)  # Flask_Login logs in user
 
         # decide where the user is redirected to after successful login
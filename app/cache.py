@@ -0,0 +1,105 @@
+# cache.py: small key/value caches shared by the search, fragment and user
+# caches. LRUCache lives in the process; RedisCache talks to a Redis-compatible
+# server so every worker process sees the same entries. Both count hits and
+# misses, and keep counters (used as generation numbers) outside the LRU so
+# they are never evicted. RedisCache stores values as JSON, never pickles:
+# unpickling lets whoever can write to the server run code in the app.
+import json
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, value), oldest first
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time()):
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        with self.lock:
+            self.entries[key] = (time() + ttl if ttl else None, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def counter(self, key):
+        return self.counters.get(key, 0)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+class RedisCache(object):
+
+    def __init__(self, url, prefix, ttl=None):
+        import redis  # optional dependency, only needed when a shared cache URL is configured
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + 'counter:' + key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + 'counter:' + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def make_cache(url, prefix, maxsize=1024, ttl=None):  # shared cache when url is set, else in-process LRU
+    if url:
+        return RedisCache(url, prefix, ttl)
+    return LRUCache(maxsize, ttl)
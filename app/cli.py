@@ -0,0 +1,79 @@
+# cli.py: custom `flask` commands, registered on the app in microblog.py
+import click
+
+
+def register(app):
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--batch-size', default=None, type=int, help='Queue rows per bulk request.')
+    def drain(batch_size):
+        """Send all due operations in the search queue to the search index."""
+        from app.models import SearchQueue
+        total = 0
+        while True:
+            handled = SearchQueue.drain(batch_size)
+            if not handled:
+                break
+            total += handled
+        depth = SearchQueue.depth()
+        click.echo('Drained {} operations, {} still queued ({} waiting for a retry).'.format(
+            total, depth['pending'], depth['retrying']))
+
+    @search.command()
+    def status():
+        """Show the search queue depth."""
+        from app.models import SearchQueue
+        depth = SearchQueue.depth()
+        click.echo('pending: {pending}\nretrying: {retrying}\noldest_age: {oldest_age:.0f}s'.format(**depth))
+
+    @search.command()
+    @click.argument('model', default='post')
+    @click.option('--chunk-size', default=None, type=int, help='Rows per bulk request.')
+    def reindex(model, chunk_size):
+        """Rebuild the search index of MODEL from the database."""
+        from app.models import searchable_models
+        searchable_models()[model].reindex(chunk_size)
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command()
+    @click.option('--fix', is_flag=True, help='Correct the counters that drifted.')
+    def verify(fix):
+        """Compare follower/following counters with the followers table."""
+        from app.models import User
+        drift = User.verify_follow_counts(fix)
+        for user, followers_count, followers, followed_count, followed in drift:
+            click.echo('{}: followers {} (real {}), following {} (real {})'.format(
+                user.username, followers_count, followers, followed_count, followed))
+        click.echo('{} users drifted{}.'.format(len(drift), ', fixed' if fix and drift else ''))
+
+    @app.cli.group()
+    def bench():
+        """Benchmarking commands."""
+        pass
+
+    @bench.command()
+    @click.option('--users', default=10000, help='Number of users to create.')
+    @click.option('--posts', default=100000, help='Number of posts to create.')
+    @click.option('--follows', default=50, help='Average number of users each user follows.')
+    @click.option('--days', default=365, help='Posts are spread over this many days before 2024-01-01 (app/seed.py EPOCH).')
+    @click.option('--seed', default=42, help='Random seed, the same seed gives the same data.')
+    @click.option('--index', is_flag=True, help='Also rebuild the search index.')
+    def seed(users, posts, follows, days, seed, index):
+        """Fill the database with generated users, follows and posts."""
+        from time import time
+        from app.seed import seed as seed_database
+        from app.models import Post
+        start = time()
+        users, follows, posts = seed_database(users, posts, follows, days, seed, echo=click.echo)
+        click.echo('Seeded {} users, {} follows and {} posts in {:.1f}s'.format(
+            users, follows, posts, time() - start))
+        if index:
+            Post.reindex()
@@ -1,14 +1,110 @@
-from threading import Thread
+# emails.py: outgoing mail goes through a bounded queue drained by a small
+# pool of worker threads (MAIL_WORKERS). Each worker keeps one SMTP connection
+# open while there is mail to send instead of connecting once per message.
+# Failed messages are retried with backoff, and queued mail is drained at exit.
+# Without workers (MAIL_WORKERS=0, or after stop()) mail is sent on the calling
+# thread, and a failure is logged instead of failing the request.
+import atexit
+import queue
+import threading
+from time import sleep
 from flask_mail import Message
 from flask import current_app
 from app import mail
 
-def send_async_email(app, msg):  # runs in a background thread invoked via Thread()
-    with app.app_context():  # sends application context into custom thread because mail.send() needs the apps configuration files to access email server, app instance available via `current_app` variable from Flask
-        mail.send(msg)
+STOP = object()  # queued once per worker at shutdown, after the remaining mail
+
+
+class MailQueue(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        self.workers = []
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.sent = 0
+        self.failed = 0
+
+    def submit(self, msg):  # returns False when the message was dropped
+        with self.lock:
+            if self.app.config['MAIL_WORKERS'] and not self.workers and not self.stopped:
+                self.start()
+            pooled = bool(self.workers)
+        if not pooled:
+            return self.send_now(msg)
+        try:
+            self.queue.put((msg, 0), timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            self.app.logger.warning('Mail queue full, dropped message to %s', msg.recipients)
+            return False
+        return True
+
+    def send_now(self, msg):
+        try:
+            mail.send(msg)
+        except Exception:
+            self.failed += 1
+            self.app.logger.exception('Sending mail to %s failed, dropped the message', msg.recipients)
+            return False
+        self.sent += 1
+        return True
+
+    def start(self):
+        for i in range(self.app.config['MAIL_WORKERS']):
+            worker = threading.Thread(target=self.run, name='mail-worker-{}'.format(i), daemon=True)
+            self.workers.append(worker)
+            worker.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=30):  # workers send everything queued before the stop markers
+        with self.lock:
+            workers, self.workers = self.workers, []
+            self.stopped = True
+        for worker in workers:
+            self.queue.put(STOP)
+        for worker in workers:
+            worker.join(timeout)
+
+    def run(self):
+        with self.app.app_context():
+            item = self.queue.get()
+            while item is not STOP:
+                item = self.deliver(item)
+
+    def deliver(self, item):
+        # sends item and whatever else gets queued while the connection is open,
+        # returns the next item to handle once the queue has been idle for a while
+        pending = item  # the message being sent, None once it went through
+        try:
+            with mail.connect() as conn:
+                while pending is not None:
+                    conn.send(pending[0])
+                    pending = None
+                    self.sent += 1
+                    try:
+                        item = self.queue.get(timeout=self.app.config['MAIL_IDLE_TIMEOUT'])
+                    except queue.Empty:
+                        item = None
+                    if item is not STOP:
+                        pending = item
+        except Exception:
+            if pending is None:  # quitting a connection that already went away
+                self.app.logger.warning('Closing mail connection failed', exc_info=True)
+                return item or self.queue.get()
+            msg, attempts = pending[0], pending[1] + 1
+            if attempts >= self.app.config['MAIL_MAX_ATTEMPTS']:
+                self.failed += 1
+                self.app.logger.exception('Giving up sending mail to %s', msg.recipients)
+                return self.queue.get()
+            self.app.logger.warning('Sending mail to %s failed, attempt %d', msg.recipients, attempts)
+            sleep(min(self.app.config['MAIL_RETRY_BACKOFF'] * 2 ** (attempts - 1), 60))
+            return msg, attempts
+        return item or self.queue.get()
+
 
 def send_email(subject, sender, recipients, text_body, html_body):  # basic implementation of sending an email
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+    return current_app.mailer.submit(msg)  # sent by a background worker
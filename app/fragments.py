@@ -0,0 +1,25 @@
+# fragments.py: cache of rendered post rows (_post_fragment.html). A post's body
+# never changes after it is created, so its HTML only depends on the post and
+# its author's username and avatar, which are all part of the cache key. The
+# timestamp is rendered by moment.js in the browser, so cached rows don't go stale.
+# Keys also carry a digest of the template, so a deploy that changes the row
+# starts on new keys, and the old ones expire after FRAGMENT_CACHE_TTL.
+from hashlib import md5
+from flask import current_app, render_template
+from jinja2 import Markup
+
+
+def template_version(app):  # digest of _post_fragment.html, computed once in create_app
+    source = app.jinja_env.loader.get_source(app.jinja_env, '_post_fragment.html')[0]
+    return md5(source.encode('utf-8')).hexdigest()[:8]
+
+
+def render_post(post):
+    author = post.author
+    key = '{}:{}:{}:{}:{}'.format(current_app.fragment_version, post.id, author.id,
+                                  author.avatar_hash, author.username)
+    html = current_app.fragment_cache.get(key)
+    if html is None:
+        html = render_template('_post_fragment.html', post=post)
+        current_app.fragment_cache.set(key, html)
+    return Markup(html)
@@ -0,0 +1,107 @@
+# fulltext.py: search engine built on the database's own full-text search,
+# used by app/search.py when ELASTICSEARCH_URL is not set. SQLite keeps a
+# copy of the __searchable__ fields in an FTS5 table named <index>_fts (rowid
+# is the model id) that add()/remove() maintain. PostgreSQL searches the model
+# table directly through a GIN expression index over to_tsvector(), which the
+# database keeps up to date by itself, so add()/remove() have nothing to do.
+from app import db
+
+LANGUAGE = 'english'  # text search configuration used by PostgreSQL
+
+
+def engine():  # name of the database full-text engine, None if the database has none
+    dialect = db.get_engine().dialect.name
+    return dialect if dialect in ('sqlite', 'postgresql') else None
+
+
+def searchable_fields(index):  # __searchable__ of the model class stored in table `index`
+    for cls in db.Model._decl_class_registry.values():
+        if getattr(cls, '__tablename__', None) == index and hasattr(cls, '__searchable__'):
+            return cls.__searchable__
+    raise KeyError('No searchable model for index {}'.format(index))
+
+
+def document(fields):  # SQL expression of the text PostgreSQL indexes for `fields`
+    return "to_tsvector('{}', {})".format(LANGUAGE, " || ' ' || ".join(
+        "coalesce({}, '')".format(field) for field in fields))
+
+
+def create_ddl(index, fields):  # statements building the full-text index of `index`
+    return {
+        'sqlite': ['CREATE VIRTUAL TABLE IF NOT EXISTS {}_fts USING fts5({})'.format(
+                       index, ', '.join(fields)),
+                   'INSERT INTO {0}_fts (rowid, {1}) SELECT id, {1} FROM {0}'.format(
+                       index, ', '.join(fields))],
+        'postgresql': ['CREATE INDEX IF NOT EXISTS ix_{}_fts ON {} USING gin ({})'.format(
+                           index, index, document(fields))],
+    }
+
+
+def drop_ddl(index):
+    return {
+        'sqlite': ['DROP TABLE IF EXISTS {}_fts'.format(index)],
+        'postgresql': ['DROP INDEX IF EXISTS ix_{}_fts'.format(index)],
+    }
+
+
+def register(model):
+    # creates/drops the full-text index together with the model table, so
+    # db.create_all() and db.drop_all() handle it like any other table
+    table = model.__table__
+    for dialect, statements in create_ddl(table.name, model.__searchable__).items():
+        for statement in statements:
+            db.event.listen(table, 'after_create', db.DDL(statement).execute_if(dialect=dialect))
+    for dialect, statements in drop_ddl(table.name).items():
+        for statement in statements:
+            db.event.listen(table, 'before_drop', db.DDL(statement).execute_if(dialect=dialect))
+
+
+def add(index, model):
+    if engine() == 'sqlite':
+        remove(index, model)
+        fields = model.__searchable__
+        db.session.execute('INSERT INTO {}_fts (rowid, {}) VALUES (:id, {})'.format(
+            index, ', '.join(fields), ', '.join(':' + field for field in fields)),
+            dict({field: getattr(model, field) for field in fields}, id=model.id))
+
+
+def remove(index, model):
+    if engine() == 'sqlite':
+        db.session.execute('DELETE FROM {}_fts WHERE rowid = :id'.format(index), {'id': model.id})
+
+
+def rebuild(index):  # refills the whole index from the model table, returns the number of rows
+    if engine() == 'sqlite':
+        db.session.execute('DELETE FROM {}_fts'.format(index))
+        db.session.execute(create_ddl(index, searchable_fields(index))['sqlite'][1])
+    db.session.commit()
+    return db.session.execute('SELECT count(*) FROM {}'.format(index)).scalar()
+
+
+def query(index, expression, page, per_page):
+    # returns ids ordered by relevance and the total number of matches, the
+    # same contract as the Elasticsearch query in app/search.py
+    terms = expression.split()
+    if not terms:
+        return [], 0
+    params = {'limit': per_page, 'offset': (page - 1) * per_page}
+    if engine() == 'sqlite':
+        # every term is quoted so user input can't use FTS5 query syntax, and
+        # terms are OR'ed like Elasticsearch's multi_match does by default
+        params['match'] = ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        ids = [id for id, in db.session.execute(
+            'SELECT rowid FROM {}_fts WHERE {}_fts MATCH :match ORDER BY rank '
+            'LIMIT :limit OFFSET :offset'.format(index, index), params)]
+        total = db.session.execute('SELECT count(*) FROM {}_fts WHERE {}_fts MATCH :match'.format(
+            index, index), params).scalar()
+        return ids, total
+    # plainto_tsquery() parses user input safely but ANDs the terms, switch them to OR
+    params['query'] = expression
+    doc = document(searchable_fields(index))
+    tsquery = "to_tsquery('{0}', replace(plainto_tsquery('{0}', :query)::text, '&', '|'))".format(LANGUAGE)
+    ids = [id for id, in db.session.execute(
+        'SELECT id FROM {0} WHERE {1} @@ {2} ORDER BY ts_rank({1}, {2}) DESC, id DESC '
+        'LIMIT :limit OFFSET :offset'.format(index, doc, tsquery), params)]
+    total = db.session.execute('SELECT count(*) FROM {} WHERE {} @@ {}'.format(
+        index, doc, tsquery), params).scalar()
+    return ids, total
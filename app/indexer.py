@@ -0,0 +1,61 @@
+# indexer.py: pool of background threads that drain the search_queue outbox
+# table (see SearchQueue in app/models.py) into the search index, so posting
+# never waits on Elasticsearch. Each worker handles its own shard of object
+# ids, so repeated updates to one object are always coalesced by one worker.
+import atexit
+import threading
+from app import db
+
+
+class SearchIndexer(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = []
+        self.wakeups = []
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.sent = 0  # queue rows handled by this process, exposed with the queue depth
+
+    def notify(self):  # called after a commit queued changes, starts the pool on first use
+        if not self.app.config['SEARCH_QUEUE_WORKERS']:
+            return
+        with self.lock:
+            if not self.workers:
+                self.start()
+        for wakeup in self.wakeups:
+            wakeup.set()
+
+    def start(self):
+        shards = self.app.config['SEARCH_QUEUE_WORKERS']
+        for shard in range(shards):
+            wakeup = threading.Event()
+            worker = threading.Thread(target=self.run, args=(shard, shards, wakeup),
+                                      name='search-indexer-{}'.format(shard), daemon=True)
+            self.wakeups.append(wakeup)
+            self.workers.append(worker)
+            worker.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10):  # lets workers finish the batch they are sending
+        self.stopping.set()
+        for wakeup in self.wakeups:
+            wakeup.set()
+        for worker in self.workers:
+            worker.join(timeout)
+
+    def run(self, shard, shards, wakeup):
+        from app.models import SearchQueue
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    handled = SearchQueue.drain(shard=shard, shards=shards)
+                except Exception:
+                    self.app.logger.exception('Search indexer worker %d failed', shard)
+                    handled = 0
+                finally:
+                    db.session.remove()
+                self.sent += handled
+                if not handled:  # queue is empty or only has rows waiting for a retry
+                    wakeup.wait(self.app.config['SEARCH_QUEUE_POLL_INTERVAL'])
+                    wakeup.clear()
@@ -0,0 +1,200 @@
+# instrumentation.py: opt-in per-request timing (INSTRUMENTATION_ENABLED).
+# Records SQL statements (count, total time, slowest ones), search calls,
+# template rendering and password hashing for each request, and reports them
+# in a Server-Timing header, a structured log line (see app/logs.py) and
+# Prometheus histograms served at /metrics, to clients from
+# METRICS_ALLOWED_ADDRESSES or sending METRICS_TOKEN.
+import hmac
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+from flask import g, request, has_request_context, current_app, template_rendered, \
+    before_render_template, Response, abort
+from sqlalchemy.engine import Engine
+from app import db
+
+CATEGORIES = ('db', 'search', 'render', 'auth')  # timed parts of a request, besides the total
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+
+
+class RequestMetrics(object):  # what one request spent its time on, kept in g
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.durations = dict.fromkeys(CATEGORIES, 0.0)
+        self.queries = 0
+        self.statements = []  # (seconds, statement), only the slowest are kept
+        self.render_depth = 0  # templates rendered from inside other templates are counted once
+
+    def add_statement(self, seconds, statement):
+        self.queries += 1
+        self.durations['db'] += seconds
+        self.statements.append((seconds, statement))
+        self.statements.sort(key=lambda item: item[0], reverse=True)
+        del self.statements[current_app.config['INSTRUMENTATION_SLOW_STATEMENTS']:]
+
+
+def current_metrics():
+    if has_request_context():
+        return g.get('request_metrics')
+    return None
+
+
+@contextmanager
+def timed(category):  # adds the time spent in the block to the current request
+    metrics = current_metrics()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.durations[category] += perf_counter() - start
+
+
+class Histogram(object):  # Prometheus histogram with one series per label value
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.series = {}  # label value -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value):
+        with self.lock:
+            series = self.series.setdefault(label_value, [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for label_value, series in sorted(self.series.items()):
+                label = '{}="{}"'.format(self.label, label_value)
+                for bound, count in zip(BUCKETS, series):
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound, count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label, series[-1]))
+                lines.append('{}_sum{{{}}} {}'.format(self.name, label, series[-2]))
+                lines.append('{}_count{{{}}} {}'.format(self.name, label, series[-1]))
+        return lines
+
+
+class Instrumentation(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.histograms = {
+            'total': Histogram('microblog_request_seconds', 'Request duration.', 'route'),
+            'db': Histogram('microblog_request_db_seconds', 'Time spent in SQL per request.', 'route'),
+            'search': Histogram('microblog_request_search_seconds', 'Time spent in search calls per request.', 'route'),
+            'render': Histogram('microblog_request_render_seconds', 'Time spent rendering templates per request.', 'route'),
+            'auth': Histogram('microblog_request_auth_seconds', 'Time spent hashing passwords per request.', 'route'),
+        }
+        self.queries = Histogram('microblog_request_queries', 'SQL statements per request.', 'route')
+        self.queue_depth = (0, None)  # (expires, SearchQueue.depth()) shared by scrapes
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        before_render_template.connect(self.before_render, app)
+        template_rendered.connect(self.after_render, app)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+        listen_to_engines()
+
+    def before_request(self):
+        g.request_metrics = RequestMetrics()
+
+    def before_render(self, app, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None:
+            if metrics.render_depth == 0:
+                metrics.render_start = perf_counter()
+            metrics.render_depth += 1
+
+    def after_render(self, app, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None and metrics.render_depth:
+            metrics.render_depth -= 1
+            if metrics.render_depth == 0:
+                metrics.durations['render'] += perf_counter() - metrics.render_start
+
+    def after_request(self, response):
+        metrics = current_metrics()
+        if metrics is None or request.endpoint == 'metrics':
+            return response
+        total = perf_counter() - metrics.start
+        route = request.endpoint or 'unknown'
+        for category in CATEGORIES:
+            self.histograms[category].observe(metrics.durations[category], route)
+        self.histograms['total'].observe(total, route)
+        self.queries.observe(metrics.queries, route)
+        timings = ['{};dur={:.2f}'.format(category, metrics.durations[category] * 1000)
+                   for category in CATEGORIES]
+        timings[0] += ';desc="{} queries"'.format(metrics.queries)
+        timings.append('total;dur={:.2f}'.format(total * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+        self.app.logger.info(
+            '%s %s %s %.2fms %d queries', request.method, route, response.status_code,
+            total * 1000, metrics.queries, extra={'fields': {
+                'event': 'request', 'method': request.method,
+                'status': response.status_code, 'ms': round(total * 1000, 2),
+                'queries': metrics.queries,
+                'ms_by_part': {category: round(metrics.durations[category] * 1000, 2) for category in CATEGORIES},
+                'slowest': [{'ms': round(seconds * 1000, 2), 'sql': statement[:200]}
+                            for seconds, statement in metrics.statements]}})
+        return response
+
+    def allowed(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+            return True
+        return request.remote_addr in self.app.config['METRICS_ALLOWED_ADDRESSES']
+
+    def search_queue_depth(self):  # one query per METRICS_QUEUE_TTL, however often /metrics is scraped
+        expires, depth = self.queue_depth
+        if depth is None or expires < time():
+            from app.models import SearchQueue
+            depth = SearchQueue.depth()
+            self.queue_depth = (time() + self.app.config['METRICS_QUEUE_TTL'], depth)
+        return depth
+
+    def metrics(self):  # Prometheus text exposition format
+        if not self.allowed():
+            abort(403)
+        lines = []
+        for histogram in list(self.histograms.values()) + [self.queries]:
+            lines.extend(histogram.render())
+        for name, cache in (('search', self.app.search_cache), ('fragment', self.app.fragment_cache)):
+            stats = cache.stats()
+            lines.append('# TYPE microblog_{}_cache_hits counter'.format(name))
+            lines.append('microblog_{}_cache_hits {}'.format(name, stats['hits']))
+            lines.append('# TYPE microblog_{}_cache_misses counter'.format(name))
+            lines.append('microblog_{}_cache_misses {}'.format(name, stats['misses']))
+        depth = self.search_queue_depth()
+        for key in ('pending', 'retrying', 'oldest_age'):
+            lines.append('# TYPE microblog_search_queue_{} gauge'.format(key))
+            lines.append('microblog_search_queue_{} {}'.format(key, depth[key]))
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+_listening = False
+
+def listen_to_engines():
+    # listens on the Engine class so every engine (and any engine created
+    # later) is covered; statements outside an instrumented request are ignored
+    global _listening
+    if _listening:
+        return
+    _listening = True
+
+    @db.event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_metrics() is not None:
+            conn.info.setdefault('query_start', []).append(perf_counter())
+
+    @db.event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        metrics = current_metrics()
+        if metrics is not None and conn.info.get('query_start'):
+            metrics.add_statement(perf_counter() - conn.info['query_start'].pop(), statement)
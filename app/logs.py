@@ -0,0 +1,227 @@
+# logs.py: non-blocking structured logging. Request threads only put records
+# on a queue (QueueHandler); a QueueListener thread formats them as JSON lines
+# and does the file/stream I/O. Each record carries the request id, user id and
+# route of the request that logged it. Error mails are batched into one digest
+# per LOG_MAIL_INTERVAL so an error storm sends a handful of mails, not thousands.
+import atexit
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import smtplib
+import threading
+import uuid
+from datetime import datetime
+from email.message import EmailMessage
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, \
+    TimedRotatingFileHandler
+from time import time
+from flask import g, request, has_request_context, _request_ctx_stack
+from flask.logging import default_handler
+
+
+class RequestContextFilter(logging.Filter):  # runs on the request thread, before the record is queued
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = request_id()
+            record.route = request.endpoint
+            record.user_id = loaded_user_id()
+        else:
+            record.request_id = record.route = record.user_id = None
+        return True
+
+
+class RequestQueueHandler(QueueHandler):
+    # QueueHandler.prepare folds the traceback into the message; keep it apart
+    # so the JSON lines have it in its own field
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def loaded_user_id():
+    # id of the user Flask-Login already loaded for this request, if any. A log
+    # call must not run load_user (a cache or database round trip that can fail)
+    user = getattr(_request_ctx_stack.top, 'user', None) or g.get('_login_user')  # Flask-Login 0.5, 0.6+
+    return getattr(user, 'id', None)
+
+
+def request_id():  # taken from the proxy's X-Request-ID header if there is one
+    if 'request_id' not in g:
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    return g.request_id
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'user_id': getattr(record, 'user_id', None),
+            'route': getattr(record, 'route', None),
+        }
+        entry.update(getattr(record, 'fields', None) or {})  # structured data passed with extra={'fields': ...}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def gzip_namer(name):
+    return name + '.gz'
+
+
+def gzip_rotator(source, dest):  # compresses the rotated file, on the listener thread
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def file_handler(config):  # size based rotation by default, time based when LOG_ROTATE_WHEN is set
+    if not os.path.exists(config['LOG_DIR']):
+        os.mkdir(config['LOG_DIR'])
+    path = os.path.join(config['LOG_DIR'], 'microblog.log')
+    if config['LOG_ROTATE_WHEN']:
+        handler = TimedRotatingFileHandler(path, when=config['LOG_ROTATE_WHEN'],
+                                           backupCount=config['LOG_BACKUP_COUNT'], utc=True)
+    else:
+        handler = RotatingFileHandler(path, maxBytes=config['LOG_ROTATE_BYTES'],
+                                      backupCount=config['LOG_BACKUP_COUNT'])
+    if config['LOG_COMPRESS']:
+        handler.namer = gzip_namer
+        handler.rotator = gzip_rotator
+    return handler
+
+
+class BatchingSMTPHandler(logging.Handler):
+    # collects error records and mails them as one digest at most once per
+    # interval. Anything past max_records in an interval is only counted.
+
+    def __init__(self, mailhost, port, fromaddr, toaddrs, subject, credentials=None,
+                 secure=False, interval=300, max_records=50):
+        super().__init__(logging.ERROR)
+        self.mailhost = mailhost
+        self.port = port
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.secure = secure
+        self.interval = interval
+        self.max_records = max_records
+        self.buffer = []
+        self.dropped = 0
+        self.last_sent = 0
+        self.timer = None
+        self.buffer_lock = threading.Lock()
+
+    def emit(self, record):
+        with self.buffer_lock:
+            if len(self.buffer) < self.max_records:
+                self.buffer.append(self.format(record))
+            else:
+                self.dropped += 1
+            wait = self.last_sent + self.interval - time()
+            if wait > 0:  # sent recently, the rest of this interval goes in the next digest
+                if self.timer is None:
+                    self.timer = threading.Timer(wait, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self.buffer_lock:
+            records, self.buffer = self.buffer, []
+            dropped, self.dropped = self.dropped, 0
+            self.timer = None
+            if not records:
+                return
+            self.last_sent = time()
+        body = '\n\n'.join(records)
+        if dropped:
+            body += '\n\n... and {} more errors not included'.format(dropped)
+        message = EmailMessage()
+        message['Subject'] = '{} ({} errors)'.format(self.subject, len(records) + dropped)
+        message['From'] = self.fromaddr
+        message['To'] = ', '.join(self.toaddrs)
+        message.set_content(body)
+        try:
+            self.send(message)
+        except Exception:
+            logging.getLogger(__name__).warning('could not send error mail', exc_info=True)
+
+    def send(self, message):
+        with smtplib.SMTP(self.mailhost, self.port, timeout=10) as smtp:
+            if self.secure:
+                smtp.starttls()
+            if self.credentials:
+                smtp.login(*self.credentials)
+            smtp.send_message(message)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.flush()
+        super().close()
+
+
+class LogPipeline(object):  # the queue, the listener thread and the handlers it feeds
+
+    def __init__(self, app):
+        config = app.config
+        self.handlers = []
+        if config['LOG_TO_STDOUT']:
+            self.handlers.append(logging.StreamHandler())
+        else:
+            self.handlers.append(file_handler(config))
+        for handler in self.handlers:
+            handler.setFormatter(JSONFormatter())
+            handler.setLevel(logging.INFO)
+        if config['MAIL_SERVER']:  # errors are mailed to the admins
+            credentials = None
+            if config['MAIL_USERNAME'] or config['MAIL_PASSWORD']:
+                credentials = (config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+            mail_handler = BatchingSMTPHandler(
+                config['MAIL_SERVER'], config['MAIL_PORT'], 'no-reply@' + config['MAIL_SERVER'],
+                config['ADMINS'], 'Microblog Failure', credentials=credentials,
+                secure=config['MAIL_USE_TLS'], interval=config['LOG_MAIL_INTERVAL'],
+                max_records=config['LOG_MAIL_MAX_RECORDS'])
+            mail_handler.setFormatter(JSONFormatter())
+            self.handlers.append(mail_handler)
+
+        self.logger = app.logger
+        self.logger.removeHandler(default_handler)  # flask's own handler writes to stderr on the request thread
+        self.queue_handler = RequestQueueHandler(queue.Queue(-1))
+        self.queue_handler.addFilter(RequestContextFilter())
+        self.logger.addHandler(self.queue_handler)
+        self.logger.setLevel(logging.INFO)
+        self.listener = QueueListener(self.queue_handler.queue, *self.handlers,
+                                      respect_handler_level=True)
+        self.listener.start()
+        self.running = True
+        atexit.register(self.stop)
+
+    def stop(self):  # writes out what is still queued, sends the pending error digest
+        if not self.running:
+            return
+        self.running = False
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
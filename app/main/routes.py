@@ -1,19 +1,94 @@
 # main/routes.py: Handles general routing
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, current_app, g
+from hashlib import md5
+from time import time
+from flask import render_template, flash, redirect, url_for, request, current_app, g, session
 from flask_login import current_user, login_required
 from app import db
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
-from app.models import User, Post
+from app.models import User, Post, timeline
+from app.pagination import paginate_by_cursor
+from app.rows import post_rows, with_author_columns
 from app.main import bp
 
 
+# returns one page of posts plus next/prev links for the listing views. Uses
+# keyset pagination when a cursor is passed or POSTS_CURSOR_PAGINATION is on,
+# and the OFFSET based paginate() for ?page=N links. With recent (the
+# RecentPosts buffer) pages it holds are served without querying query.
+# Posts are returned as PostRow objects read with one SELECT (see app/rows.py).
+def paginate_posts(query, endpoint, recent=None, **url_args):
+    per_page = current_app.config['POSTS_PER_PAGE']
+    query = with_author_columns(query)
+    cursor = request.args.get('cursor')
+    if cursor is not None or (current_app.config['POSTS_CURSOR_PAGINATION']
+                              and 'page' not in request.args):
+        posts = recent.cursor_page(cursor, per_page) if recent else None
+        if posts is None:
+            posts = paginate_by_cursor(query, cursor, per_page)
+            posts.items = post_rows(posts.items)
+        next_url = url_for(endpoint, cursor=posts.next_cursor, **url_args) if posts.has_next else None
+        prev_url = url_for(endpoint, cursor=posts.prev_cursor, **url_args) if posts.has_prev else None
+        return posts.items, next_url, prev_url
+    page = request.args.get(key='page', default=1, type=int)  # request.args.get with key page is getting string query in case user presses link for page 2, 3, etc... otherwise default page 1
+    buffered = recent.offset_page(page, per_page) if recent and page > 0 else None
+    if buffered is not None:
+        items, has_next = buffered
+        next_url = url_for(endpoint, page=page + 1, **url_args) if has_next else None
+        prev_url = url_for(endpoint, page=page - 1, **url_args) if page > 1 else None
+        return items, next_url, prev_url
+    posts = query.paginate(page, per_page, False)  # False parameter returns empty page instead of 404 error if trying to navigate to a page that doesn't exist
+    if posts.has_next:
+        next_url = url_for(endpoint, page=posts.next_num, **url_args)
+    else:
+        next_url = None
+    if posts.has_prev:
+        prev_url = url_for(endpoint, page=posts.prev_num, **url_args)
+    else:
+        prev_url = None
+    return post_rows(posts.items), next_url, prev_url  # items is list of items retrieved for selected page
+
+
+# conditional GET: views call not_modified() with a cheap fingerprint of what
+# the page shows (newest post, counters, ...) before running the page query.
+# The ETag also covers the viewer, the query string (page/cursor) and a half
+# hour bucket so cached forms never carry an expired CSRF token. Pages with
+# pending flash messages are always rendered. Returns True when the client's
+# copy is current and the view can answer 304 without rendering.
+def not_modified(*fingerprint, last_modified=None):
+    if request.method != 'GET' or session.get('_flashes'):
+        return False
+    csrf_bucket = int(time() // 1800)
+    etag = md5(repr(fingerprint + (current_user.id, current_user.username, current_user.avatar_hash,
+                                   request.full_path, csrf_bucket)).encode('utf-8')).hexdigest()
+    g.page_validators = etag, last_modified
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return last_modified is not None and request.if_modified_since is not None and \
+        last_modified.replace(microsecond=0) <= request.if_modified_since
+
+@bp.after_request
+def add_page_validators(response):
+    validators = g.pop('page_validators', None)
+    if validators and response.status_code in (200, 304):
+        etag, last_modified = validators
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.cache_control.private = True  # pages are per user, shared caches must not keep them
+        response.cache_control.no_cache = True  # always revalidate, usually with a 304
+        response.vary.add('Cookie')
+    return response
+
+def newest_post(query):  # (timestamp, id) of the newest post in query, read from the index
+    return query.order_by(None).order_by(Post.timestamp.desc(), Post.id.desc()).with_entities(
+        Post.timestamp, Post.id).first()
+
+
 # @ are decorators that modify function, telling app what to do for diff URLs
 @bp.before_request
-def before_request():  # tracks when user was last seen, writes to db
+def before_request():  # tracks when user was last seen, buffered and written to db in batches
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.presence.touch(current_user)
         g.search_form = SearchForm()  # explain
 
 @bp.route('/', methods=['GET', 'POST'])
@@ -27,34 +102,28 @@ def index():  # shows form for adding a post and all followed posts
         db.session.commit()
         flash('Your post has been submitted!')
         return redirect(url_for('main.index'))
-    page = request.args.get(key='page', default=1, type=int)
-    posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)  # False parameter returns empty page instead of 404 error if trying to navigate to a page that doesn't exist
-    if posts.has_next:
-        next_url = url_for('main.index', page=posts.next_num)
-    else:
-        next_url = None
-    if posts.has_prev:
-        prev_url = url_for('main.index', page=posts.prev_num)
-    else:
-        prev_url = None
-    return render_template('index.html', title='Home', form=form, posts=posts.items, next_url=next_url, prev_url=prev_url)  # items is list of items retrieved for selected page
+    if request.method == 'GET':
+        timeline_rows = db.session.query(db.func.count()).select_from(timeline).filter(
+            timeline.c.user_id == current_user.id).scalar()  # changes when follows add or remove posts
+        if not_modified(newest_post(current_user.timeline_posts()), timeline_rows, current_user.followed_count,
+                        current_app.recent_posts.author_generation()):  # renamed authors
+            return '', 304
+    posts, next_url, prev_url = paginate_posts(current_user.timeline_posts(), 'main.index')
+    return render_template('index.html', title='Home', form=form, posts=posts, next_url=next_url, prev_url=prev_url)
 
 @bp.route('/user/<username>')  # profile page for User
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()  # returns 404 if no user by that username found
-    page = request.args.get(key='page', default=1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)  # False parameter returns empty page instead of 404 error if trying to navigate to a page that doesn't exist
-    if posts.has_next:
-        next_url = url_for('main.user', username=user.username, page=posts.next_num)  # need username = user.username argument because url_for has to point back to same profile
-    else:
-        next_url = None
-    if posts.has_prev:
-        prev_url = url_for('main.user', username=user.username, page=posts.prev_num)
-    else:
-        prev_url = None
+    last_seen = current_app.presence.last_seen(user)  # includes times not written to the db yet
+    if not_modified(newest_post(user.posts), user.username, user.about_me, user.avatar_hash, last_seen,
+                    user.followers_count, user.followed_count, current_user.is_following(user)):
+        return '', 304
+    posts, next_url, prev_url = paginate_posts(user.posts.order_by(Post.timestamp.desc()),
+                                               'main.user', username=user.username)  # need username = user.username argument because url_for has to point back to same profile
     form = EmptyForm()  # add options to follow or unfollow, specified by username.
-    return render_template('user.html', user=user, posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    return render_template('user.html', user=user, posts=posts, form=form, next_url=next_url, prev_url=prev_url,
+                           last_seen=last_seen)
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
@@ -112,17 +181,14 @@ def unfollow(username):
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get(key='page', default=1, type=int)  # request.args.get with key page is getting string query in case user presses link for page 2, 3, etc... otherwise default page 1
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)  # False parameter returns empty page instead of 404 error if trying to navigate to a page that doesn't exist
-    if posts.has_next:
-        next_url = url_for('main.explore', page=posts.next_num)
-    else:
-        next_url = None
-    if posts.has_prev:
-        prev_url = url_for('main.explore', page=posts.prev_num)
-    else:
-        prev_url = None
-    return render_template('index.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url)  # page.items is list of items retrieved for selected page
+    recent = current_app.recent_posts
+    newest = recent.newest()
+    last_modified = max(filter(None, [newest[0] if newest else None, recent.authors_changed]), default=None)
+    if not_modified(newest, recent.author_generation(), last_modified=last_modified):  # new posts or renamed authors
+        return '', 304
+    posts, next_url, prev_url = paginate_posts(Post.query.order_by(Post.timestamp.desc()), 'main.explore',
+                                               recent=current_app.recent_posts)  # first pages come from memory
+    return render_template('index.html', title='Explore', posts=posts, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/search')
@@ -133,6 +199,7 @@ def search():
     page = request.args.get('page', 1, type=int)
     posts, total = Post.search(g.search_form.q.data, page,
                                current_app.config['POSTS_PER_PAGE'])
+    posts = post_rows(with_author_columns(posts))
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
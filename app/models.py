@@ -1,12 +1,16 @@
 # this module defines models to support SQLAlchemy object-relational mapping
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import current_app
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
-from werkzeug.security import generate_password_hash, check_password_hash
+from app.search import query_index, bulk_index, invalidate_index, rebuild_index, \
+    create_index, send_bulk, swap_index
+from app import fulltext
+from app.instrumentation import timed
 from flask_login import UserMixin  # includes generic implementations for user model classes
 from time import time
 from hashlib import md5
+from uuid import uuid4
+from functools import lru_cache
 import jwt
 
 # this class links SQLAlchemy and Elasticsearch, will be the actual functions I call in the app
@@ -18,7 +22,7 @@ class SearchableMixin(object):
     # object itself is needed because I need to pass SQLAlchemy models to
     # templates for rendering return results.
     def search(cls, expression, page, per_page):  # first argument is a class, for example Post model
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total = query_index(cls.__tablename__, expression, page, per_page, cls.__searchable__)
         if total == 0:
             return cls.query.filter_by(id=0), 0
         when = []  # list of tuples, where tuples are pairs of id index and id value at that index
@@ -30,55 +34,371 @@ class SearchableMixin(object):
         # same order as the IDs they are given
 
     @classmethod
-    # this function saves objects (which will help identify which objects are
-    # going to be added, modified, and deleted) from session because they won't
-    # be available after commit.
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-            }
+    # this function writes the objects that were added, modified, and deleted
+    # to the search_queue outbox table in the same transaction, instead of
+    # calling Elasticsearch while the request waits. New objects already have
+    # their ids here, and session.new/dirty/deleted still show this flush.
+    def after_flush(cls, session, flush_context):
+        changes = []
+        for obj in session.new:
+            if isinstance(obj, SearchableMixin):
+                changes.append({'index': obj.__tablename__, 'object_id': obj.id, 'action': 'index'})
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and obj.searchable_changed():
+                changes.append({'index': obj.__tablename__, 'object_id': obj.id, 'action': 'index'})
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                changes.append({'index': obj.__tablename__, 'object_id': obj.id, 'action': 'delete'})
+        if changes:
+            session.execute(SearchQueue.__table__.insert(), changes)
+            session.info.setdefault('search_queued', set()).update(
+                change['index'] for change in changes)
 
     @classmethod
-    # this function makes changes to Elasticsearch side. Iterate over added,
-    # modified, and deleted objects to make corresponding calls to indexing
-    # functions in app/search.py for the objects that have the SearchableMixin class.
+    # this function wakes the background indexer (app/indexer.py) once the
+    # queued changes are committed and visible to it, and drops cached search
+    # pages of the touched indexes, and of the database full-text indexes that
+    # a drain (bulk_index) wrote to in this transaction
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        for index in session.info.pop('search_changed', ()):
+            invalidate_index(index)
+        indexes = session.info.pop('search_queued', None)
+        if indexes:
+            for index in indexes:
+                invalidate_index(index)
+            current_app.indexer.notify()
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_queued', None)
+        session.info.pop('search_changed', None)
+
+    def searchable_changed(self):  # true if a flush changes any of the __searchable__ fields
+        state = db.inspect(self)
+        return any(state.attrs[field].history.has_changes() for field in self.__searchable__)
 
     @classmethod
-    # this helper function refreshes index with all data from relational side
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    # this helper function refreshes index with all data from relational side.
+    # Elasticsearch gets a new version of the index, filled by streaming rows
+    # in chunks and sending each chunk as one bulk request, while searches
+    # keep using the old one; the alias is switched over once it is complete.
+    # Drains write to the new index too while it is built, so rows are sent
+    # with op_type create (a newer drained copy is kept) and rows deleted
+    # since they were read are removed again after each chunk
+    def reindex(cls, chunk_size=None):
+        rebuilt = rebuild_index(cls.__tablename__)
+        if rebuilt is not None:  # database full-text index, rebuilt with one INSERT ... SELECT
+            print('Reindexed {} {}'.format(rebuilt, cls.__tablename__))
+            return rebuilt
+        if not current_app.elasticsearch:
+            print('none reindex')
+            return 0
+        chunk_size = chunk_size or current_app.config['ELASTICSEARCH_BULK_SIZE']
+        name = create_index(cls)
+        total = cls.query.count()
+        done, batch, start = 0, [], time()
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+        def send(batch):
+            failed = send_bulk(batch)
+            present = set(id for id, in db.session.query(cls.id).filter(
+                cls.id.in_([obj.id for action, index, obj in batch])))
+            gone = [('delete', name, obj) for action, index, obj in batch if obj.id not in present]
+            if gone:
+                send_bulk(gone)
+            return len(batch) - len(failed) - len(gone)
+
+        query = cls.query.options(db.lazyload('*')).order_by(cls.id).yield_per(chunk_size)
+        for obj in query:
+            batch.append(('create', name, obj))
+            if len(batch) == chunk_size:
+                done += send(batch)
+                batch = []
+                print('Reindexed {}/{} {} ({:.0f}/s)'.format(
+                    done, total, cls.__tablename__, done / max(time() - start, 1e-6)))
+        if batch:
+            done += send(batch)
+        swap_index(cls, name)
+        print('Reindexed {} {} into {} in {:.1f}s'.format(done, cls.__tablename__, name, time() - start))
+        return done
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', lambda session, previous_transaction:
+                SearchableMixin.after_rollback(session))
+
+# this class is the outbox of pending search index operations, written by
+# SearchableMixin.after_flush and drained by the background indexer
+class SearchQueue(db.Model):
+    __tablename__ = 'search_queue'
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64))  # table name of the searchable model
+    object_id = db.Column(db.Integer)
+    action = db.Column(db.String(8))  # 'index' or 'delete'
+    attempts = db.Column(db.Integer, default=0)
+    available_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)  # pushed back after failures, or to the end of a claim
+    claimed_by = db.Column(db.String(32))  # drain() that is sending the row, until available_at
+
+    def __repr__(self):
+        return '<SearchQueue: {} {} {}>'.format(self.action, self.index, self.object_id)
+
+    @classmethod
+    # sends one batch of due operations as a bulk request and removes them from
+    # the queue. Repeated operations on the same object are coalesced so only
+    # the newest one is sent. With shards > 1 only rows whose object_id falls in
+    # `shard` are handled, which lets several workers drain without overlap;
+    # workers in other processes are kept apart by claim(). Operations the search index rejects are retried like a failed request.
+    # Returns the number of queue rows handled.
+    def drain(cls, batch_size=None, shard=0, shards=1):
+        rows = cls.claim(batch_size or current_app.config['ELASTICSEARCH_BULK_SIZE'], shard, shards)
+        if not rows:
+            return 0
+        latest = {}
+        for row in rows:  # rows are in queue order, so later operations win
+            latest[(row.index, row.object_id)] = row.action
+        models = searchable_models()
+        changes = []
+        for index in set(index for index, object_id in latest):
+            ids = [object_id for i, object_id in latest if i == index]
+            objects = {obj.id: obj for obj in models[index].query.options(
+                db.lazyload('*')).filter(models[index].id.in_(ids))}
+            for object_id in ids:
+                obj = objects.get(object_id)
+                if latest[(index, object_id)] == 'index' and obj is not None:
+                    changes.append(('index', index, obj))
+                else:  # deleted, or deleted again after being queued for indexing
+                    changes.append(('delete', index, obj or DeletedObject(object_id)))
+        try:
+            failed = bulk_index(changes)
+        except Exception:
+            current_app.logger.exception('Search indexing failed, retrying %d operations later', len(rows))
+            db.session.rollback()
+            cls.retry_later(rows)
+            return 0
+        failed = set((index, model.id) for action, index, model in failed)
+        retry = [row for row in rows if (row.index, row.object_id) in failed]
+        cls.query.filter(cls.id.in_([row.id for row in rows if row not in retry])).delete(
+            synchronize_session=False)
+        if retry:
+            cls.retry_later(retry)  # commits
+        else:
+            db.session.commit()
+        return len(rows) - len(retry)
+
+    @classmethod
+    # takes due rows for this drain, so workers in other processes don't send
+    # them too: the rows get a claim token and their available_at is moved to
+    # the end of a SEARCH_QUEUE_LEASE, after which a crashed worker's rows are
+    # due again. Objects with rows claimed by another drain are skipped, so an
+    # old index operation can't land after a newer delete. PostgreSQL skips
+    # rows that a concurrent claim has locked (FOR UPDATE SKIP LOCKED), other
+    # databases rely on the UPDATE only matching rows that are still due.
+    def claim(cls, batch_size, shard=0, shards=1):
+        now = datetime.utcnow()
+        token = uuid4().hex
+        other = db.aliased(cls)
+        due = db.session.query(cls.id).filter(cls.available_at <= now, ~db.exists().where(db.and_(
+            other.index == cls.index, other.object_id == cls.object_id,
+            other.claimed_by.isnot(None), other.available_at > now)))
+        if shards > 1:
+            due = due.filter(cls.object_id % shards == shard)
+        due = due.order_by(cls.id).limit(batch_size).with_for_update(skip_locked=True)
+        claimed = cls.query.filter(cls.id.in_(due.subquery()), cls.available_at <= now).update(
+            {'claimed_by': token,
+             'available_at': now + timedelta(seconds=current_app.config['SEARCH_QUEUE_LEASE'])},
+            synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return []
+        return cls.query.filter_by(claimed_by=token).order_by(cls.id).all()
+
+    @classmethod
+    # pushes failed rows back with exponential backoff, giving up after
+    # SEARCH_QUEUE_MAX_ATTEMPTS
+    def retry_later(cls, rows):
+        now = datetime.utcnow()
+        for row in rows:
+            row.claimed_by = None
+            row.attempts = (row.attempts or 0) + 1
+            if row.attempts >= current_app.config['SEARCH_QUEUE_MAX_ATTEMPTS']:
+                current_app.logger.error('Dropping %r after %d attempts', row, row.attempts)
+                db.session.delete(row)
+            else:
+                row.available_at = now + timedelta(seconds=min(2 ** row.attempts, 300))
+        db.session.commit()
+
+    @classmethod
+    # queue depth metrics in one query: pending rows, rows waiting for a retry
+    # and how long the longest waiting row has been due, in seconds
+    def depth(cls):
+        now = datetime.utcnow()
+        pending, retrying, oldest = db.session.query(
+            db.func.count(cls.id), db.func.count(db.case([(cls.attempts > 0, 1)])),
+            db.func.min(cls.available_at)).one()
+        oldest_age = max((now - oldest).total_seconds(), 0) if oldest is not None else 0
+        return {'pending': pending, 'retrying': retrying, 'oldest_age': oldest_age}
+
+class DeletedObject(object):  # stands in for a model that is already gone when its delete is sent
+    def __init__(self, id):
+        self.id = id
+
+def searchable_models():  # maps index name to model class for every SearchableMixin model
+    return {cls.__tablename__: cls for cls in db.Model._decl_class_registry.values()
+            if isinstance(cls, type) and issubclass(cls, SearchableMixin)}
+
+# this class keeps a materialized home timeline per user (fan-out-on-write), so
+# the index page reads one indexed page instead of running the followed_posts()
+# UNION. Posts are pushed to followers when they are flushed, which keeps the
+# timeline rows in the same transaction as the post itself.
+class Timeline(object):
+
+    @classmethod
+    # new Post objects have their ids here but are still listed in session.new.
+    # Entries of deleted posts go with them (ondelete='CASCADE'), this also
+    # removes them where foreign keys are not enforced (SQLite by default)
+    def after_flush(cls, session, flush_context):
+        for obj in session.new:
+            if isinstance(obj, Post):
+                cls.push(session, obj)
+        deleted = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+        if deleted:
+            session.execute(timeline.delete().where(timeline.c.post_id.in_(deleted)))
+
+    @classmethod
+    # copies a new post into the author's own timeline and, unless the author is
+    # a celebrity, into the timeline of every follower
+    def push(cls, session, post):
+        session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([Post.user_id, Post.id, Post.timestamp]).where(Post.id == post.id)))
+        if cls.is_celebrity(post.user_id):
+            cls.trim(session, [post.user_id])
+            return
+        session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([followers.c.follower_id, Post.id, Post.timestamp]).where(
+                db.and_(followers.c.followed_id == Post.user_id, Post.id == post.id,
+                        followers.c.follower_id != Post.user_id))))  # own posts were added above
+        recipients = [id for id, in session.execute(db.select([followers.c.follower_id]).where(
+            followers.c.followed_id == post.user_id))]
+        cls.trim(session, recipients + [post.user_id])
+
+    @classmethod
+    # copies the newest posts of the users in `author_ids` into the timeline of
+    # `user`, skipping celebrities and the user's own posts (always there)
+    def backfill(cls, session, user, author_ids):
+        users = User.__table__
+        newest = db.select([db.literal(user.id), Post.id, Post.timestamp]).select_from(
+            Post.__table__.join(users, users.c.id == Post.user_id)).where(db.and_(
+            Post.user_id.in_(author_ids), Post.user_id != user.id,
+            db.func.coalesce(users.c.followers_count, 0) <= current_app.config['TIMELINE_CELEBRITY_THRESHOLD'])
+            ).order_by(Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+        session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], newest))
+        cls.trim(session, [user.id])
+
+    @classmethod
+    # copies the newest posts of the users in `author_ids` into the timeline of
+    # each of their followers, for authors who stopped being celebrities and so
+    # are no longer read on demand. Entries already there are skipped
+    def fan_out(cls, session, author_ids):
+        for author_id in author_ids:
+            newest = db.select([Post.id, Post.timestamp]).where(Post.user_id == author_id).order_by(
+                Post.timestamp.desc()).limit(current_app.config['TIMELINE_LENGTH']).alias('newest')
+            session.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'],
+                db.select([followers.c.follower_id, newest.c.id, newest.c.timestamp]).where(db.and_(
+                    followers.c.followed_id == author_id, followers.c.follower_id != author_id,
+                    ~db.exists().where(db.and_(timeline.c.user_id == followers.c.follower_id,
+                                               timeline.c.post_id == newest.c.id))))))
+            cls.trim(session, [id for id, in session.execute(db.select([followers.c.follower_id]).where(
+                followers.c.followed_id == author_id))])
+
+    @classmethod
+    # drops the posts of the users in `author_ids` from the timeline of `user`
+    def remove(cls, session, user, author_ids):
+        session.execute(timeline.delete().where(db.and_(
+            timeline.c.user_id == user.id,
+            timeline.c.post_id.in_(db.select([Post.id]).where(db.and_(
+                Post.user_id.in_(author_ids), Post.user_id != user.id))))))
+
+    @classmethod
+    # rebuilds every timeline from the followers and post tables in one
+    # INSERT ... SELECT, for bulk loads that bypass the session (app/seed.py)
+    def rebuild(cls, session):
+        users = User.__table__
+        posts = Post.__table__
+        entries = db.union_all(
+            db.select([followers.c.follower_id.label('user_id'), posts.c.id.label('post_id'),
+                       posts.c.timestamp.label('timestamp')]).select_from(
+                followers.join(posts, posts.c.user_id == followers.c.followed_id).join(
+                    users, users.c.id == followers.c.followed_id)).where(db.and_(
+                followers.c.follower_id != posts.c.user_id,
+                db.func.coalesce(users.c.followers_count, 0) <= current_app.config['TIMELINE_CELEBRITY_THRESHOLD'])),
+            db.select([posts.c.user_id, posts.c.id, posts.c.timestamp])).alias('entries')
+        ranked = db.select([entries.c.user_id, entries.c.post_id, entries.c.timestamp,
+                            db.func.row_number().over(partition_by=entries.c.user_id,
+                                                      order_by=entries.c.timestamp.desc()).label('position')]
+                           ).alias('ranked')
+        session.execute(timeline.delete())
+        session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([ranked.c.user_id, ranked.c.post_id, ranked.c.timestamp]).where(
+                ranked.c.position <= current_app.config['TIMELINE_LENGTH'])))
+
+    @classmethod
+    # keeps only the newest TIMELINE_LENGTH entries for the given user ids. The
+    # cutoff is looked up once per user through the (user_id, timestamp) index,
+    # then the older entries are deleted in one executemany
+    def trim(cls, session, user_ids):
+        if not user_ids:
+            return
+        users = User.__table__
+        cutoff = db.select([timeline.c.timestamp]).where(
+            timeline.c.user_id == users.c.id).order_by(
+            timeline.c.timestamp.desc()).limit(1).offset(
+            current_app.config['TIMELINE_LENGTH'] - 1).as_scalar()
+        full = [{'b_user_id': id, 'b_cutoff': timestamp} for id, timestamp in session.execute(
+            db.select([users.c.id, cutoff]).where(users.c.id.in_(user_ids))) if timestamp is not None]
+        if full:
+            session.execute(timeline.delete().where(db.and_(
+                timeline.c.user_id == db.bindparam('b_user_id'),
+                timeline.c.timestamp < db.bindparam('b_cutoff'))), full)
+
+    @staticmethod
+    # celebrity authors are not fanned out, their posts are read with the old query
+    def is_celebrity(user_id):
+        count = db.session.query(User.followers_count).filter(User.id == user_id).scalar()
+        return (count or 0) > current_app.config['TIMELINE_CELEBRITY_THRESHOLD']
+
+db.event.listen(db.session, 'after_flush', Timeline.after_flush)
 
 # creating association table to integrate follower relationship
 followers = db.Table('followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    db.Index('ix_followers_follower_id_followed_id', 'follower_id', 'followed_id', unique=True),  # one row per pair, backs is_following()
+    db.Index('ix_followers_followed_id', 'followed_id')  # for listing a user's followers
+)
+
+# creating materialized home timeline table, filled by the Timeline class above
+timeline = db.Table('timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('timestamp', db.DateTime),  # copy of Post.timestamp so a page is read from one index
+    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp')
 )
 
 class User(UserMixin, db.Model):  # User class inherits from db.Model, base class for all models from SQLAlchemy. Also inherits UserMixin to implement login
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    avatar_hash = db.Column(db.String(32))  # md5 of the lowercased email, kept in sync by validate_email()
     password_hash = db.Column(db.String(128), unique=True)
-    posts = db.relationship('Post', backref='author', lazy='dynamic')  # sets relationship between users and posts, allows for queries like user.posts
+    posts = db.relationship('Post', backref=db.backref('author', lazy='joined'), lazy='dynamic')  # sets relationship between users and posts, allows for queries like user.posts. Authors are joined into every post query so listings don't load them one by one
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    followers_count = db.Column(db.Integer, default=0, server_default='0')  # denormalized counts kept by follow()/unfollow(), `flask counters verify` reconciles drift
+    followed_count = db.Column(db.Integer, default=0, server_default='0')
 
     followed = db.relationship(  # sets up querying what following relationships
         'User', secondary=followers,  # secondary is association table
@@ -91,21 +411,103 @@ class User(UserMixin, db.Model):  # User class inherits from db.Model, base clas
         return '<User: {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.passwords.hash(password)
 
-    def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+    def check_password(self, password):  # also upgrades a hash made with an old method, the caller commits
+        with timed('auth'):
+            if not current_app.passwords.verify(self.password_hash, password):
+                return False
+            if current_app.passwords.needs_rehash(self.password_hash):
+                self.set_password(password)
+        return True
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.adjust_follow_counts([user], 1)
+            Timeline.backfill(db.session, self, [user.id])
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.adjust_follow_counts([user], -1)
+            Timeline.remove(db.session, self, [user.id])
+
+    def is_following(self, user):  # EXISTS lookup on the (follower_id, followed_id) index
+        return db.session.query(db.exists().where(db.and_(
+            followers.c.follower_id == self.id, followers.c.followed_id == user.id))).scalar()
+
+    # set-oriented versions of follow()/unfollow()/is_following(), each runs a
+    # fixed number of statements no matter how many users are passed
+    def follow_many(self, users):  # returns the number of users newly followed
+        db.session.flush()  # the statements below bypass the unit of work
+        status = self.following_status([user.id for user in users])
+        new = [user for user in {user.id: user for user in users}.values() if not status[user.id]]
+        if not new:
+            return 0
+        db.session.execute(insert_ignore(followers).values([
+            {'follower_id': self.id, 'followed_id': user.id} for user in new]))
+        self.adjust_follow_counts(new, 1)
+        Timeline.backfill(db.session, self, [user.id for user in new])
+        return len(new)
 
-    def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0  # use filter() vs filter_by() to set arbitrary filtering conditions
+    def unfollow_many(self, users):  # returns the number of users unfollowed
+        db.session.flush()
+        status = self.following_status([user.id for user in users])
+        old = [user for user in {user.id: user for user in users}.values() if status[user.id]]
+        if not old:
+            return 0
+        db.session.execute(followers.delete().where(db.and_(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id.in_([user.id for user in old]))))
+        self.adjust_follow_counts(old, -1)
+        Timeline.remove(db.session, self, [user.id for user in old])
+        return len(old)
+
+    def following_status(self, user_ids):  # maps each id to whether self follows that user
+        followed = set(id for id, in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id, followers.c.followed_id.in_(user_ids)))
+        return {id: id in followed for id in user_ids}
+
+    def adjust_follow_counts(self, users, delta):
+        # increments in SQL (count = count + delta) so concurrent follows don't
+        # overwrite each other, then expires the stale values loaded in memory
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id == self.id).values(
+            followed_count=table.c.followed_count + delta * len(users)))
+        db.session.execute(table.update().where(table.c.id.in_([user.id for user in users])).values(
+            followers_count=table.c.followers_count + delta))
+        if delta < 0:  # authors back at the threshold have posts that were never fanned out
+            Timeline.fan_out(db.session, [id for id, in db.session.execute(db.select([table.c.id]).where(db.and_(
+                table.c.id.in_([user.id for user in users]),
+                table.c.followers_count == current_app.config['TIMELINE_CELEBRITY_THRESHOLD'])))])
+        db.session.expire(self, ['followed_count'])
+        for user in users:
+            db.session.expire(user, ['followers_count'])
+        db.session.info.setdefault('users_changed', set()).update([self.id] + [user.id for user in users])
+
+    @staticmethod
+    # compares the counter columns with the followers table and returns the
+    # users that drifted as (user, followers_count, real followers, followed_count,
+    # real followed). With fix=True the counters are also corrected.
+    def verify_follow_counts(fix=False):
+        real_followers = db.select([db.func.count()]).where(
+            followers.c.followed_id == User.id).as_scalar()
+        real_followed = db.select([db.func.count()]).where(
+            followers.c.follower_id == User.id).as_scalar()
+        drift = db.session.query(User, User.followers_count, real_followers,
+                                 User.followed_count, real_followed).filter(db.or_(
+            db.func.coalesce(User.followers_count, 0) != real_followers,
+            db.func.coalesce(User.followed_count, 0) != real_followed)).all()
+        if fix and drift:
+            users = User.__table__
+            db.session.execute(users.update().where(users.c.id.in_([row[0].id for row in drift])).values(
+                followers_count=db.select([db.func.count()]).where(
+                    followers.c.followed_id == users.c.id).as_scalar(),
+                followed_count=db.select([db.func.count()]).where(
+                    followers.c.follower_id == users.c.id).as_scalar()))
+            db.session.commit()
+        return drift
 
     def followed_posts(self):  # returns list of self's posts and followed user's posts
         others = Post.query.join(followers, (followers.c.followed_id == Post.user_id)  # join Posts table with follower association table where follower's followed_id == Post's user_id
@@ -113,10 +515,24 @@ class User(UserMixin, db.Model):  # User class inherits from db.Model, base clas
         own = Post.query.filter_by(user_id=self.id) # get own posts
         return others.union(own).order_by(Post.timestamp.desc())  # sort posts by time in descending order
 
+    def timeline_posts(self):  # same posts as followed_posts(), read from the materialized timeline
+        posts = Post.query.join(timeline, timeline.c.post_id == Post.id
+            ).filter(timeline.c.user_id == self.id)
+        followed_celebrities = [id for id, in db.session.query(followers.c.followed_id).join(
+            User, User.id == followers.c.followed_id).filter(
+            followers.c.follower_id == self.id,
+            User.followers_count > current_app.config['TIMELINE_CELEBRITY_THRESHOLD'])]
+        if followed_celebrities:  # celebrity posts are never fanned out, fall back to querying them
+            posts = posts.union(Post.query.filter(Post.user_id.in_(followed_celebrities)))
+        return posts.order_by(Post.timestamp.desc())
+
+    @db.validates('email')  # runs whenever email is set, so the gravatar digest never goes stale
+    def validate_email(self, key, email):
+        self.avatar_hash = email_digest(email)
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+        return avatar_url(self.avatar_hash or email_digest(self.email), size)
 
     def get_reset_password_token(self, expires_in=600):  # reset token expires in 10 minutes
         return jwt.encode({'reset_password': self.id, 'exp':time() + expires_in},
@@ -133,6 +549,10 @@ class User(UserMixin, db.Model):  # User class inherits from db.Model, base clas
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    __table_args__ = (  # composite indexes backing keyset pagination in app/pagination.py
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_user_id_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -141,6 +561,69 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return '<Post: {}>'.format(self.body)
 
+fulltext.register(Post)  # database full-text index used when Elasticsearch isn't configured
+
+def insert_ignore(table):
+    # multi-row INSERT that skips rows violating a unique constraint, in the
+    # current database's dialect
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+def email_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest() if email else None
+
+@lru_cache(maxsize=4096)  # templates ask for the same few (user, size) urls on every page
+def avatar_url(digest, size):
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
+        digest, size)
+
+CACHED_USER_COLUMNS = [column.key for column in User.__table__.columns
+                       if column.key != 'password_hash']  # no secrets in a shared cache
+SNAPSHOT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def user_snapshot(user):  # JSON friendly column values cached by load_user
+    data = {key: getattr(user, key) for key in CACHED_USER_COLUMNS}
+    if data['last_seen'] is not None:
+        data['last_seen'] = data['last_seen'].strftime(SNAPSHOT_TIME_FORMAT)
+    return data
+
 @login.user_loader
+# loads user from ID, ties in LoginManager and User from database. Column
+# values are cached for USER_CACHE_TTL seconds, a cached user is merged into
+# the session with load=False so identifying the caller costs no SELECT.
+# password_hash is not cached, check_password loads it when it is needed
 def load_user(id):
-    return User.query.get(int(id))  # loads user from ID, ties in LoginManager and User from database
+    data = current_app.user_cache.get(id)
+    if data is not None:
+        user = User(**dict(data, last_seen=data['last_seen'] and  # a copy, the LRU hands out the stored dict
+                           datetime.strptime(data['last_seen'], SNAPSHOT_TIME_FORMAT)))
+        db.make_transient_to_detached(user)  # clean, as if it had just been loaded
+        return db.session.merge(user, load=False)
+    user = User.query.get(int(id))
+    if user is not None:
+        current_app.user_cache.set(id, user_snapshot(user))
+    return user
+
+# cached users are dropped once a commit changes their row. Changes made with
+# UPDATE statements (see User.adjust_follow_counts) are added to the set by hand
+def user_cache_after_flush(session, flush_context):
+    changed = [user.id for user in session.dirty if isinstance(user, User) and session.is_modified(user)]
+    changed += [user.id for user in session.deleted if isinstance(user, User)]
+    if changed:
+        session.info.setdefault('users_changed', set()).update(changed)
+
+def user_cache_after_commit(session):
+    for id in session.info.pop('users_changed', ()):
+        current_app.user_cache.delete(str(id))
+
+db.event.listen(db.session, 'after_flush', user_cache_after_flush)
+db.event.listen(db.session, 'after_commit', user_cache_after_commit)
+db.event.listen(db.session, 'after_soft_rollback', lambda session, previous_transaction:
+                session.info.pop('users_changed', None))
@@ -0,0 +1,54 @@
+# pagination.py: keyset (cursor) pagination for post listings. Instead of
+# OFFSET + COUNT(*) like paginate(), pages are read with a WHERE on the
+# (timestamp, id) of the last post shown and one extra row decides has_next.
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from app import db
+from app.models import Post
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class CursorPage(object):
+    # mirrors the parts of Flask-SQLAlchemy's Pagination that the views use
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = encode_cursor('next', items[-1]) if has_next else None
+        self.prev_cursor = encode_cursor('prev', items[0]) if has_prev else None
+
+
+def encode_cursor(direction, post):  # opaque token so clients don't depend on its format
+    raw = '{}|{}|{}'.format(direction, post.timestamp.strftime(TIMESTAMP_FORMAT), post.id)
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):  # returns (direction, timestamp, id), or None for a bad token
+    try:
+        direction, timestamp, id = urlsafe_b64decode(token.encode('ascii')).decode('utf-8').split('|')
+        if direction not in ('next', 'prev'):
+            return None
+        return direction, datetime.strptime(timestamp, TIMESTAMP_FORMAT), int(id)
+    except (ValueError, UnicodeError):
+        return None
+
+
+def paginate_by_cursor(query, cursor, per_page):
+    # query is any Post query, its ordering is replaced by (timestamp, id) desc
+    query = query.order_by(None)
+    decoded = decode_cursor(cursor) if cursor else None
+    if decoded is None:  # first page
+        items = query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(per_page + 1).all()
+        return CursorPage(items[:per_page], len(items) > per_page, False)
+    direction, timestamp, id = decoded
+    if direction == 'next':  # older posts than the cursor
+        items = query.filter(db.or_(Post.timestamp < timestamp, db.and_(
+            Post.timestamp == timestamp, Post.id < id))).order_by(
+            Post.timestamp.desc(), Post.id.desc()).limit(per_page + 1).all()
+        return CursorPage(items[:per_page], len(items) > per_page, True)
+    # newer posts than the cursor, read upwards and flipped back to newest first
+    items = query.filter(db.or_(Post.timestamp > timestamp, db.and_(
+        Post.timestamp == timestamp, Post.id > id))).order_by(
+        Post.timestamp.asc(), Post.id.asc()).limit(per_page + 1).all()
+    return CursorPage(items[:per_page][::-1], True, len(items) > per_page)
@@ -0,0 +1,121 @@
+# passwords.py: password hashing and login throttling.
+# PasswordHasher hashes with PASSWORD_HASH_METHOD (a werkzeug method string,
+# the iteration count is the cost) and verifies in a small process pool so
+# PBKDF2 does not hold the web worker; hashes made with an older method are
+# flagged so they can be upgraded on the next successful login.
+# LoginRateLimiter keeps token buckets per username and, when client addresses
+# are known (see LOGIN_LIMIT_BY_ADDRESS), per client address. It is checked
+# before any hashing, so a credential stuffing burst costs a dict
+# lookup per attempt instead of a full PBKDF2 run.
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasherBusy(Exception):  # every pool slot stayed taken for PASSWORD_HASH_TIMEOUT
+    pass
+
+
+class PasswordHasher(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.pool = None
+        self.lock = threading.Lock()
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        self.slots = threading.BoundedSemaphore(workers * app.config['PASSWORD_HASH_QUEUE_PER_WORKER'] or 1)
+
+    def hash(self, password):
+        return generate_password_hash(password, method=self.app.config['PASSWORD_HASH_METHOD'],
+                                      salt_length=self.app.config['PASSWORD_SALT_LENGTH'])
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        if not self.app.config['PASSWORD_HASH_WORKERS']:
+            return check_password_hash(pwhash, password)
+        # bounded: at most workers * PASSWORD_HASH_QUEUE_PER_WORKER checks queued or running
+        if not self.slots.acquire(timeout=self.app.config['PASSWORD_HASH_TIMEOUT']):
+            raise PasswordHasherBusy()
+        try:
+            return self.executor().submit(check_password_hash, pwhash, password).result()
+        finally:
+            self.slots.release()
+
+    def needs_rehash(self, pwhash):  # True when the hash was made with another method or cost
+        return pwhash.split('$', 1)[0] != self.app.config['PASSWORD_HASH_METHOD']
+
+    def executor(self):  # started on first use, so processes are not started at import time
+        with self.lock:
+            if self.pool is None:
+                # not forked: by now this process runs threads (log listener, search
+                # and mail workers) whose locks a forked child could inherit held
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self.pool = ProcessPoolExecutor(self.app.config['PASSWORD_HASH_WORKERS'], mp_context=context)
+                atexit.register(self.close)
+            return self.pool
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.updated = now
+
+
+class LoginRateLimiter(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.buckets = {}  # (kind, key) -> TokenBucket
+        self.lock = threading.Lock()
+
+    def by_address(self):  # False when every client could share one proxy's address
+        return bool(self.app.config['LOGIN_LIMIT_BY_ADDRESS'] or self.app.config['PROXY_FIX_X_FOR'])
+
+    def limits(self):  # (capacity, tokens added per second) by bucket kind
+        config = self.app.config
+        return {'username': (config['LOGIN_USERNAME_BURST'], config['LOGIN_USERNAME_PER_MINUTE'] / 60.0),
+                'address': (config['LOGIN_ADDRESS_BURST'], config['LOGIN_ADDRESS_PER_MINUTE'] / 60.0)}
+
+    def allow(self, username, address):  # takes a token from every bucket, or from none
+        limits = self.limits()
+        keys = [('username', (username or '').lower())]
+        if self.by_address():
+            keys.append(('address', address))
+        now = monotonic()
+        with self.lock:
+            buckets = []
+            for kind, key in keys:
+                capacity, rate = limits[kind]
+                bucket = self.buckets.get((kind, key))
+                if bucket is None:
+                    bucket = self.buckets[(kind, key)] = TokenBucket(capacity, now)
+                else:
+                    bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) * rate)
+                    bucket.updated = now
+                buckets.append(bucket)
+            if any(bucket.tokens < 1 for bucket in buckets):
+                return False
+            for bucket in buckets:
+                bucket.tokens -= 1
+            if len(self.buckets) > self.app.config['LOGIN_RATE_LIMIT_KEYS']:
+                self.prune(now, limits)
+        return True
+
+    def prune(self, now, limits):  # forgets buckets that have refilled, they behave like new ones
+        for (kind, key), bucket in list(self.buckets.items()):
+            capacity, rate = limits[kind]
+            if bucket.tokens + (now - bucket.updated) * rate >= capacity:
+                del self.buckets[(kind, key)]
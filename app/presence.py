@@ -0,0 +1,57 @@
+# presence.py: buffers "last seen" times in memory instead of committing one
+# write transaction per request. A user's time is only recorded when the stored
+# value is older than LAST_SEEN_GRANULARITY, and recorded times are written in
+# one executemany UPDATE every LAST_SEEN_FLUSH_INTERVAL seconds (and at exit).
+import atexit
+import threading
+from datetime import datetime
+from time import time
+from app import db
+
+
+class LastSeenTracker(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = {}  # user id -> last seen time not written yet
+        self.lock = threading.Lock()
+        self.last_flush = time()
+        atexit.register(self.flush_at_exit)
+
+    def touch(self, user):
+        now = datetime.utcnow()
+        with self.lock:
+            known = self.pending.get(user.id) or user.last_seen
+            if known is None or (now - known).total_seconds() >= self.app.config['LAST_SEEN_GRANULARITY']:
+                self.pending[user.id] = now
+            due = time() - self.last_flush >= self.app.config['LAST_SEEN_FLUSH_INTERVAL'] or \
+                len(self.pending) >= self.app.config['LAST_SEEN_MAX_PENDING']
+        if due:
+            self.flush()
+
+    def last_seen(self, user):  # freshest known value, including ones not written yet
+        return self.pending.get(user.id) or user.last_seen
+
+    def flush(self):  # writes all buffered times, returns how many users were updated
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time()
+        if not pending:
+            return 0
+        from app.models import User
+        statement = User.__table__.update().where(User.id == db.bindparam('b_id')).values(
+            last_seen=db.bindparam('b_last_seen'))
+        with db.engine.begin() as connection:  # own transaction, the request's session is not committed
+            connection.execute(statement, [{'b_id': id, 'b_last_seen': seen}
+                                           for id, seen in pending.items()])
+        for id in pending:  # cached users (see load_user) would still have the old time
+            self.app.user_cache.delete(str(id))
+        return len(pending)
+
+    def flush_at_exit(self):
+        if self.pending:
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:  # best effort, the database may already be gone
+                    self.app.logger.exception('Could not write buffered last_seen times')
@@ -0,0 +1,146 @@
+# recent.py: the newest RECENT_POSTS_SIZE posts kept in memory for /explore.
+# Everyone sees the same first pages of explore, so they are served from this
+# buffer instead of sorting (and counting) the post table on every visit.
+# Posts committed by this process are added from the session hooks; posts from
+# other processes show up when the buffer is reloaded, at most
+# RECENT_POSTS_MAX_AGE seconds later. Pages that reach past the oldest buffered
+# post return None and the caller falls back to a keyset query.
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from time import time
+from flask import current_app
+from app import db
+from app.pagination import CursorPage, decode_cursor
+from app.rows import AuthorRow, PostRow, post_rows, with_author_columns
+
+
+class RecentPosts(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.keys = []  # (timestamp, id) of each buffered post, oldest first
+        self.rows = []  # PostRow for each key
+        self.authors = {}  # user id -> AuthorRow shared by that user's rows
+        self.complete = False  # the buffer holds every post, so short pages are really the end
+        self.loaded = None  # time of the last full load, None until warmed
+        self.authors_changed = None  # utc datetime of the last username or avatar change seen here
+
+    def warm(self):  # loads the newest posts with their authors in one query
+        from app.models import Post
+        size = self.app.config['RECENT_POSTS_SIZE']
+        rows = post_rows(with_author_columns(Post.query).order_by(
+            Post.timestamp.desc(), Post.id.desc()).limit(size))[::-1]
+        with self.lock:
+            self.rows = rows
+            self.keys = [(row.timestamp, row.id) for row in rows]
+            self.authors = {row.author.id: row.author for row in rows}
+            self.complete = len(rows) < size
+            self.loaded = time()
+
+    def fresh(self):  # reloads the buffer when it is older than RECENT_POSTS_MAX_AGE
+        if self.loaded is None or time() - self.loaded >= self.app.config['RECENT_POSTS_MAX_AGE']:
+            self.warm()
+
+    def add(self, posts):  # posts is a list of (id, body, timestamp, AuthorRow) just committed
+        with self.lock:
+            if self.loaded is None:
+                return
+            for id, body, timestamp, snapshot in posts:
+                author = self.authors.setdefault(snapshot.id, snapshot)
+                author.username, author.avatar_hash = snapshot.username, snapshot.avatar_hash
+                key = (timestamp, id)
+                if self.keys and key < self.keys[0] and not self.complete:
+                    continue  # older than everything buffered, the database has it
+                index = bisect_left(self.keys, key)
+                self.keys.insert(index, key)
+                self.rows.insert(index, PostRow(id, body, timestamp, author))
+            excess = len(self.rows) - self.app.config['RECENT_POSTS_SIZE']
+            if excess > 0:
+                del self.keys[:excess]
+                del self.rows[:excess]
+                self.complete = False
+
+    def update_authors(self, snapshots):  # username or avatar changes of buffered authors
+        self.app.user_cache.incr('authors')
+        with self.lock:
+            self.authors_changed = datetime.utcnow()
+            for snapshot in snapshots:
+                author = self.authors.get(snapshot.id)
+                if author is not None:
+                    author.username = snapshot.username
+                    author.avatar_hash = snapshot.avatar_hash
+
+    def author_generation(self):  # bumped by every username or avatar change, shared through the user cache
+        return self.app.user_cache.counter('authors')
+
+    def newest(self):  # (timestamp, id) of the newest post, None when there are no posts
+        self.fresh()
+        with self.lock:
+            return self.keys[-1] if self.keys else None
+
+    def cursor_page(self, cursor, per_page):  # same pages as paginate_by_cursor(), or None
+        self.fresh()
+        with self.lock:
+            rows, keys, complete = self.rows, self.keys, self.complete
+            decoded = decode_cursor(cursor) if cursor else None
+            if decoded is None:  # first page
+                if len(rows) <= per_page and not complete:
+                    return None
+                return CursorPage(rows[-per_page:][::-1], len(rows) > per_page, False)
+            direction, timestamp, id = decoded
+            if direction == 'next':  # older posts than the cursor
+                end = bisect_left(keys, (timestamp, id))
+                if end <= per_page and not complete:
+                    return None
+                return CursorPage(rows[max(end - per_page, 0):end][::-1], end > per_page, True)
+            start = bisect_right(keys, (timestamp, id))  # newer posts than the cursor
+            if start == 0 and not complete:
+                return None
+            newer = rows[start:]
+            return CursorPage(newer[:per_page][::-1], True, len(newer) > per_page)
+
+    def offset_page(self, page, per_page):  # (items, has_next) for ?page=N, or None
+        self.fresh()
+        with self.lock:
+            start = (page - 1) * per_page
+            if len(self.rows) <= start + per_page and not self.complete:
+                return None
+            newest_first = self.rows[::-1]
+            return newest_first[start:start + per_page], len(self.rows) > start + per_page
+
+    # new posts and author changes are copied in after_flush, while the objects
+    # are loaded (after_commit can't emit SQL to refresh expired ones), and
+    # published in after_commit once other connections can see them
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        from app.models import Post, User
+        posts = [(obj.id, obj.body, obj.timestamp, AuthorRow.from_user(obj.author))
+                 for obj in session.new if isinstance(obj, Post) and obj.author is not None]
+        users = [AuthorRow.from_user(obj) for obj in session.dirty if isinstance(obj, User) and
+                 any(db.inspect(obj).attrs[field].history.has_changes()
+                     for field in ('username', 'email', 'avatar_hash'))]
+        if posts:
+            session.info.setdefault('recent_posts', []).extend(posts)
+        if users:
+            session.info.setdefault('recent_authors', []).extend(users)
+
+    @classmethod
+    def after_commit(cls, session):
+        posts = session.info.pop('recent_posts', None)
+        authors = session.info.pop('recent_authors', None)
+        if authors:
+            current_app.recent_posts.update_authors(authors)
+        if posts:
+            current_app.recent_posts.add(posts)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('recent_posts', None)
+        session.info.pop('recent_authors', None)
+
+db.event.listen(db.session, 'after_flush', RecentPosts.after_flush)
+db.event.listen(db.session, 'after_commit', RecentPosts.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', lambda session, previous_transaction:
+                RecentPosts.after_rollback(session))
@@ -0,0 +1,81 @@
+# replicas.py: routes reads to read replicas. Replicas are SQLALCHEMY_BINDS
+# entries whose key starts with "replica" (SQLALCHEMY_REPLICA_URIS adds them).
+# Statements run while handling GET/HEAD requests go to the replicas in turn,
+# one replica per request so counts and rows of a page agree under lag;
+# flushes, INSERT/UPDATE/DELETE statements, other request methods and code
+# outside requests (CLI, workers) use the primary. Once a request has
+# committed a write, a short-lived cookie sends that browser's reads to the
+# primary for DATABASE_STICKY_SECONDS, so users see their own posts and follows
+# even when the replicas lag behind.
+import itertools
+from time import time
+from flask import g, request, has_request_context, current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+STICKY_COOKIE = 'db_primary_until'
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+            return super().get_bind(mapper, clause)
+        own_bind = mapper is not None and mapper.persist_selectable.info.get('bind_key')
+        if own_bind or not self.replicas() or not self.use_replica():
+            return super().get_bind(mapper, clause)
+        return get_state(self.app).db.replica_engine(self.app)
+
+    def replicas(self):
+        return self.app.extensions['replicas']
+
+    def use_replica(self):
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return False
+        if self.info.get('wrote') or g.get('wrote_to_primary'):  # read this request's writes back from the primary
+            return False
+        sticky = request.cookies.get(STICKY_COOKIE, type=float)
+        return not sticky or sticky < time()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        event.listen(self.session, 'after_commit', after_commit)
+        event.listen(self.session, 'after_soft_rollback', lambda session, previous_transaction:
+                     session.info.pop('wrote', None))
+
+    def init_app(self, app):
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS')
+        if uris:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.update(('replica_{}'.format(i), uri) for i, uri in enumerate(uris))
+            app.config['SQLALCHEMY_BINDS'] = binds
+        super().init_app(app)
+        keys = sorted(key for key in (app.config.get('SQLALCHEMY_BINDS') or {}) if key.startswith('replica'))
+        app.extensions['replicas'] = itertools.cycle(keys) if keys else None
+        app.after_request(stick_to_primary)
+        app.teardown_request(lambda exc: g.pop('replica', None))
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replica_engine(self, app):  # the request's replica, the next one round robin on its first read
+        if 'replica' not in g:
+            g.replica = next(app.extensions['replicas'])
+        return self.get_engine(app, bind=g.replica)
+
+
+def after_commit(session):  # remembers that the request wrote something the user should see
+    if session.info.pop('wrote', False) and has_request_context():
+        g.wrote_to_primary = True
+
+
+def stick_to_primary(response):
+    if g.pop('wrote_to_primary', False):
+        seconds = current_app.config['DATABASE_STICKY_SECONDS']
+        response.set_cookie(STICKY_COOKIE, str(time() + seconds), max_age=seconds, httponly=True)
+    return response
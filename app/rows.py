@@ -0,0 +1,57 @@
+# rows.py: lightweight read-only stand-ins for Post and User in listings. They
+# carry just what _post_fragment.html and the pagination cursors use, so they
+# can be kept around between requests without holding ORM state. Listing
+# queries are turned into one SELECT of plain columns joining the author
+# (with_author_columns) and the result into rows (post_rows), which skips the
+# identity map and building a Post and a User per result.
+from app.models import Post, User, avatar_url, email_digest
+
+
+class AuthorRow(object):
+    __slots__ = ('id', 'username', 'avatar_hash')
+
+    def __init__(self, id, username, avatar_hash):
+        self.id = id
+        self.username = username
+        self.avatar_hash = avatar_hash
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.avatar_hash or email_digest(user.email))
+
+    def avatar(self, size):
+        return avatar_url(self.avatar_hash, size)
+
+
+class PostRow(object):
+    __slots__ = ('id', 'body', 'timestamp', 'author')
+
+    def __init__(self, id, body, timestamp, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.author = author
+
+    @classmethod
+    def from_post(cls, post, author):
+        return cls(post.id, post.body, post.timestamp, author)
+
+    def __repr__(self):
+        return '<PostRow: {}>'.format(self.body)
+
+
+def with_author_columns(query):  # any Post query, returns the columns post_rows() needs
+    return query.join(User, User.id == Post.user_id).with_entities(
+        Post.id, Post.body, Post.timestamp, User.id.label('author_id'),
+        User.username, User.avatar_hash, User.email)  # email for rows without a stored avatar_hash
+
+
+def post_rows(results):  # results of a with_author_columns() query, authors are shared per page
+    authors = {}
+    rows = []
+    for id, body, timestamp, author_id, username, avatar_hash, email in results:
+        author = authors.get(author_id)
+        if author is None:
+            author = authors[author_id] = AuthorRow(author_id, username, avatar_hash or email_digest(email))
+        rows.append(PostRow(id, body, timestamp, author))
+    return rows
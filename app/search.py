@@ -1,39 +1,274 @@
 # search.py: Elasticsearch module that is only source of Elasticsearch implementation,
 # abstraction in mind so I have flexibility to switch to different search engine
 # or change what text fields I want to add to search index other than just Posts.
+# Without ELASTICSEARCH_URL the same functions use the database's full-text
+# search in app/fulltext.py (SQLite FTS5 or PostgreSQL tsvector).
+# Elasticsearch indexes are versioned (post_v1, post_v2, ...) behind an alias
+# named after the table, see create_index() and swap_index().
+from datetime import date, datetime
+from elasticsearch import RequestError
 from flask import current_app
+from app import db, fulltext
+from app.instrumentation import timed
 
 def search_status():
-    if not current_app.elasticsearch:
-        print('Elasticsearch server not configured.')
-    else:
+    if current_app.elasticsearch:
         print('Elasticsearch server detected.')
+    elif fulltext.engine():
+        print('Elasticsearch server not configured, using {} full-text search.'.format(fulltext.engine()))
+    else:
+        print('Elasticsearch server not configured.')
 
 def add_to_index(index, model):
     if not current_app.elasticsearch:  # allows for app to continue running even
                                        # if elasticsearch service not up
-        print('none add')
+        if fulltext.engine():
+            fulltext.add(index, model)
+        else:
+            print('none add')
         return
-    payload = {}  # dictionary will specify what text fields are to be indexed per model
+    with timed('search'):
+        current_app.elasticsearch.index(index=index, id=model.id, body=index_payload(model))
+
+def index_payload(model):
+    payload = {'id': model.id}  # dictionary will specify what text fields are to be indexed per model, id is the sort tiebreaker
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    return payload
 
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
-        print('none remove')
+        if fulltext.engine():
+            fulltext.remove(index, model)
+        else:
+            print('none remove')
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    with timed('search'):
+        current_app.elasticsearch.delete(index=index, id=model.id)
 
-def query_index(index, query, page, per_page):
+# sends many index/delete operations as _bulk requests instead of one HTTP
+# request each. changes is a list of (action, index, model) tuples where action
+# is 'index' or 'delete'. Returns the changes Elasticsearch rejected (per item
+# errors like 429 or mapping errors), for the caller to retry. Cached search
+# pages are only dropped once the changes can be seen by searches: after the
+# caller commits (database full-text) or after a refresh (Elasticsearch)
+def bulk_index(changes):
     if not current_app.elasticsearch:
+        if not fulltext.engine():
+            print('none bulk')
+            return []
+        for action, index, model in changes:  # database writes, committed by the caller
+            if action == 'index':
+                fulltext.add(index, model)
+            else:
+                fulltext.remove(index, model)
+        db.session.info.setdefault('search_changed', set()).update(
+            index for action, index, model in changes)  # see SearchableMixin.after_commit
+        return []
+    indexes = set(index for action, index, model in changes)
+    for index in indexes:
+        if not current_app.elasticsearch.indices.exists(index=index):
+            # first write, create the mapped index instead of letting Elasticsearch
+            # guess a mapping. Deletes have nothing to remove from a new index
+            models = [type(model) for action, i, model in changes if i == index and action == 'index']
+            if models:
+                create_first_index(models[0])
+            else:
+                changes = [change for change in changes if change[1] != index]
+    copies = []
+    for index in indexes:
+        if current_app.elasticsearch.indices.exists_alias(name=NEXT_ALIAS.format(index)):
+            # the index is being rebuilt (see create_index), it gets the same changes
+            copies += [(action, NEXT_ALIAS.format(index), model)
+                       for action, i, model in changes if i == index]
+    failed = send_bulk(changes + copies)
+    for index in set(index for action, index, model in changes):
+        with timed('search'):
+            current_app.elasticsearch.indices.refresh(index=index)
+        invalidate_index(index)
+    live = {NEXT_ALIAS.format(index): index for index in indexes}  # a failed copy retries the change
+    return list(set((action, live.get(index, index), model) for action, index, model in failed))
+
+def send_bulk(changes):  # Elasticsearch only, no cache invalidation or rebuild targets, returns the failed changes
+    chunk_size = current_app.config['ELASTICSEARCH_BULK_SIZE']
+    failed = []
+    for start in range(0, len(changes), chunk_size):
+        chunk = changes[start:start + chunk_size]
+        body = []
+        for action, index, model in chunk:
+            body.append({action: {'_index': index, '_id': model.id}})
+            if action != 'delete':  # 'index', or 'create' which keeps a document already there
+                body.append(index_payload(model))
+        with timed('search'):
+            response = current_app.elasticsearch.bulk(body=body)
+        if response.get('errors'):  # bulk requests succeed as a whole, failures are per item
+            errors = [(change, item) for change, item in zip(chunk, response['items'])
+                      if list(item.values())[0].get('error') and not (
+                          change[0] == 'create' and list(item.values())[0].get('status') == 409)]
+            current_app.logger.error('Elasticsearch bulk request had %d failed operations: %s',
+                                     len(errors), [item for change, item in errors[:5]])
+            failed += [change for change, item in errors]
+    return failed
+
+def query_index(index, query, page, per_page, fields=('*',)):
+    if not current_app.elasticsearch and not fulltext.engine():
         print('none query')
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
+    # pages of results are cached until the index changes, see invalidate_index()
+    def page_key(page):
+        return '{}:{}:{}:{}:{}'.format(index, current_app.search_cache.counter(index),
+                                       page, per_page, ' '.join(query.lower().split()))
+    key = page_key(page)
+    cached = current_app.search_cache.get(key)
+    if cached is not None:
+        return cached
+    if not current_app.elasticsearch:
+        with timed('search'):  # overlaps with db, the query runs in the database
+            ids, total = fulltext.query(index, query, page, per_page)
+        current_app.search_cache.set(key, (ids, total))
+        return ids, total
+    body = {'query': {'multi_match': {'query': query, 'fields': list(fields)}},
+            'sort': SORT, 'size': per_page + 1,  # the extra hit tells if there is a next page
+            '_source': False,  # only the ids are used, posts are read from the database
+            'track_total_hits': current_app.config['ELASTICSEARCH_TRACK_TOTAL_HITS']}
+    # the next page continues after the last hit of the page before it
+    # (search_after) when that page was served recently, so deep pages don't
+    # make every shard collect and sort from + size hits
+    offset = (page - 1) * per_page
+    after = current_app.search_cache.get(page_key(page - 1) + ':after') if page > 1 else None
+    if after is None and offset > current_app.config['ELASTICSEARCH_MAX_FROM']:
+        after = skip_hits(index, body, offset)
+    if after is not None:
+        body['search_after'] = after
+    else:
+        body['from'] = offset
+    with timed('search'):
+        search = current_app.elasticsearch.search(index=index, body=body)
+    hits = search['hits']['hits']
+    more = len(hits) > per_page
+    hits = hits[:per_page]
+    ids = [int(hit['_id']) for hit in hits]
     # above extracts id values from much larger list of results provided by Elasticsearch
-    return ids, search['hits']['total']['value']
+    total = search['hits']['total']['value']
+    if search['hits']['total']['relation'] == 'gte':  # counting stopped at the cap
+        total = max(total, offset + per_page + 1) if more else offset + len(hits)
+    current_app.search_cache.set(key, (ids, total))
+    if hits:
+        current_app.search_cache.set(key + ':after', hits[-1]['sort'])
+    return ids, total
     # returns list of id elements for search results AND total number of results
+
+def skip_hits(index, body, offset):
+    # sort values of the hit before offset, read with search_after in steps of
+    # at most ELASTICSEARCH_MAX_FROM sort values, for deep pages opened directly
+    step = dict(body, track_total_hits=False)
+    after, skipped = None, 0
+    while skipped < offset:
+        step['size'] = min(offset - skipped, current_app.config['ELASTICSEARCH_MAX_FROM'])
+        if after is not None:
+            step['search_after'] = after
+        with timed('search'):
+            hits = current_app.elasticsearch.search(
+                index=index, body=step, filter_path=['hits.hits.sort']).get('hits', {}).get('hits', [])
+        if not hits:
+            break
+        after = hits[-1]['sort']
+        skipped += len(hits)
+    return after
+
+def rebuild_index(index):
+    # full refresh of a database full-text index in one statement, returns
+    # None when the Elasticsearch bulk path has to be used instead
+    if current_app.elasticsearch or not fulltext.engine():
+        return None
+    count = fulltext.rebuild(index)
+    invalidate_index(index)
+    return count
+
+# Elasticsearch mapping and settings of a searchable model, built from its
+# __searchable__ columns instead of letting Elasticsearch guess them from the
+# first documents. Text columns use one analyzer for indexing and searching.
+# Posts come in any language, so words are lowercased and folded to ASCII but
+# not stemmed. Fields that are not in the mapping are rejected.
+def index_mappings(model):
+    properties = {'id': {'type': 'long'}}
+    for field in model.__searchable__:
+        properties[field] = field_mapping(model.__table__.c[field].type.python_type)
+    return {'settings': {'number_of_shards': current_app.config['ELASTICSEARCH_SHARDS'],
+                         'number_of_replicas': current_app.config['ELASTICSEARCH_REPLICAS'],
+                         'analysis': ANALYSIS},
+            'mappings': {'dynamic': 'strict', 'properties': properties}}
+
+def field_mapping(python_type):
+    if issubclass(python_type, str):
+        # no positions, nothing searches phrases, so the index stays smaller
+        return {'type': 'text', 'analyzer': 'searchable_text', 'index_options': 'freqs'}
+    if issubclass(python_type, bool):
+        return {'type': 'boolean'}
+    if issubclass(python_type, int):
+        return {'type': 'long'}
+    if issubclass(python_type, float):
+        return {'type': 'double'}
+    if issubclass(python_type, (date, datetime)):
+        return {'type': 'date'}
+    return {'type': 'keyword'}
+
+ANALYSIS = {'analyzer': {'searchable_text': {
+    'type': 'custom', 'tokenizer': 'standard', 'filter': ['lowercase', 'asciifolding']}}}
+SORT = [{'_score': 'desc'},
+        {'id': {'order': 'asc', 'unmapped_type': 'long'}}]  # indexes made before explicit mappings have no id
+NEXT_ALIAS = '{}-next'  # points at an index while it is being rebuilt
+
+# creates the first version of a model's index, post_v1, behind its alias.
+# Drains in other processes may race to do the same, the loser keeps theirs.
+def create_first_index(model):
+    body = index_mappings(model)
+    body['aliases'] = {model.__tablename__: {}}
+    try:
+        current_app.elasticsearch.indices.create(index='{}_v1'.format(model.__tablename__), body=body)
+    except RequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+# creates the next version of a model's index (post_v1, post_v2, ...) for a
+# rebuild. Searches keep using the live index behind the alias; queued changes
+# are sent to both through the NEXT_ALIAS alias until swap_index(). Versions
+# left behind by a rebuild that never finished are deleted. Returns the name.
+def create_index(model):
+    es = current_app.elasticsearch
+    alias = model.__tablename__
+    versions = es.indices.get_alias(index=alias + '_v*')
+    for name, info in versions.items():
+        if alias not in info['aliases']:
+            es.indices.delete(index=name)
+    version = max([int(name.rsplit('_v', 1)[1]) for name in versions] + [0]) + 1
+    name = '{}_v{}'.format(alias, version)
+    body = index_mappings(model)
+    body['settings'].update({'refresh_interval': '-1', 'number_of_replicas': 0})  # faster bulk loading
+    body['aliases'] = {NEXT_ALIAS.format(alias): {}}
+    es.indices.create(index=name, body=body)
+    return name
+
+# makes a rebuilt index live: restores its refresh and replica settings, then
+# moves the alias to it and deletes the old versions in one atomic alias
+# update, so searches never see a missing or half built index. An index named
+# like the alias, from before indexes were versioned, is deleted the same way.
+def swap_index(model, name):
+    es = current_app.elasticsearch
+    alias = model.__tablename__
+    es.indices.put_settings(index=name, body={'index': {
+        'refresh_interval': None, 'number_of_replicas': current_app.config['ELASTICSEARCH_REPLICAS']}})
+    es.indices.refresh(index=name)
+    actions = [{'remove_index': {'index': old}}
+               for old in es.indices.get_alias(index=alias + '_v*') if old != name]
+    if es.indices.exists(index=alias) and not es.indices.exists_alias(name=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions += [{'remove': {'index': name, 'alias': NEXT_ALIAS.format(alias)}},
+                {'add': {'index': name, 'alias': alias}}]
+    es.indices.update_aliases(body={'actions': actions})
+    invalidate_index(alias)
+
+def invalidate_index(index):
+    # bumps the generation number that is part of every cached key for this
+    # index, so pages cached before the change are never read again
+    current_app.search_cache.incr(index)
@@ -0,0 +1,111 @@
+# seed.py: generates a large, realistic dataset for benchmarking (`flask bench
+# seed`): users, a power-law follow graph (a few users have most followers)
+# and posts with daytime-weighted timestamps, written with bulk Core inserts.
+# The same seed always produces the same dataset: timestamps count back from
+# a fixed EPOCH instead of the current time, so runs on different days compare.
+import random
+from bisect import bisect
+from datetime import datetime, timedelta
+from itertools import accumulate
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import User, Post, Timeline, followers, email_digest
+
+CHUNK_SIZE = 10000  # rows per executemany
+EPOCH = datetime(2024, 1, 1)  # the newest generated post and last_seen
+WORDS = ('the a to and of in is it you that he was for on are with as I his they be at one have '
+         'this from or had by hot word but what some we can out other were all there when up use '
+         'your how said an each she which do their time if will way about many then them write '
+         'would like so these her long make thing see him two has look more day could go come did '
+         'number sound no most people my over know water than call first who may down side been '
+         'now find any new work part take get place made live where after back little only round '
+         'man year came show every good me give our under name very through just form sentence '
+         'great think say help low line differ turn cause much mean before move right boy old too '
+         'same tell does set three want air well also play small end put home read hand port large '
+         'spell add even land here must big high such follow act why ask men change went light').split()
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 1, 2, 4, 6, 7, 7, 7, 8, 8, 7, 7, 7, 8, 9, 10, 10, 9, 6, 3]  # posts per hour of day
+
+
+def power_law_picker(rng, n, alpha):
+    # returns a function picking an index in range(n), where the item of
+    # popularity rank r is picked with weight 1 / (r + 1) ** alpha
+    ranks = list(range(n))
+    rng.shuffle(ranks)  # popularity is not correlated with user id
+    cumulative = list(accumulate(1.0 / (rank + 1) ** alpha for rank in ranks))
+    total = cumulative[-1]
+    return lambda: min(bisect(cumulative, rng.random() * total), n - 1)
+
+
+def insert_chunks(table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+
+
+def seed(users, posts, follows, days=365, seed=42, alpha=1.1, password='password', echo=print):
+    rng = random.Random(seed)
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    ids = range(first_id, first_id + users)
+
+    # users, all with the same password, hashed with one iteration to load fast
+    echo('Creating {} users'.format(users))
+    insert_chunks(User.__table__, ({
+        'id': id, 'username': 'user{}'.format(id), 'email': 'user{}@example.com'.format(id),
+        'avatar_hash': email_digest('user{}@example.com'.format(id)),
+        'password_hash': generate_password_hash(password, 'pbkdf2:sha256:1'),
+        'about_me': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 12))),
+        'last_seen': EPOCH - timedelta(seconds=rng.randint(0, days * 86400)),
+        'followers_count': 0, 'followed_count': 0} for id in ids))
+
+    # follow graph: out-degree is Pareto distributed around `follows`, and
+    # followed users are picked by power-law popularity
+    echo('Creating follow graph')
+    popular = power_law_picker(rng, users, alpha)
+    followers_count = [0] * users
+    followed_count = [0] * users
+
+    def edges():
+        for i in range(users):
+            wanted = min(int(follows * rng.paretovariate(2.0) / 2), users // 2)
+            targets = set()
+            while len(targets) < wanted:
+                target = popular()
+                if target != i:
+                    targets.add(target)
+            followed_count[i] = len(targets)
+            for target in targets:
+                followers_count[target] += 1
+                yield {'follower_id': ids[i], 'followed_id': ids[target]}
+    insert_chunks(followers, edges())
+    echo('Created {} follows'.format(sum(followed_count)))
+    statement = User.__table__.update().where(User.id == db.bindparam('b_id')).values(
+        followers_count=db.bindparam('b_followers'), followed_count=db.bindparam('b_followed'))
+    for start in range(0, users, CHUNK_SIZE):
+        db.session.execute(statement, [
+            {'b_id': ids[i], 'b_followers': followers_count[i], 'b_followed': followed_count[i]}
+            for i in range(start, min(start + CHUNK_SIZE, users))])
+
+    # posts: active users post more, mostly during the day
+    echo('Creating {} posts'.format(posts))
+    active = power_law_picker(rng, users, alpha)
+    now = EPOCH
+    hours = list(accumulate(HOUR_WEIGHTS))
+
+    def post_rows():
+        for _ in range(posts):
+            hour = bisect(hours, rng.random() * hours[-1])
+            timestamp = now - timedelta(days=rng.randint(0, days - 1)) + timedelta(
+                hours=hour - now.hour, seconds=rng.randint(0, 3599))
+            yield {'body': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 25)))[:140],
+                   'timestamp': min(timestamp, now), 'user_id': ids[active()]}
+    insert_chunks(Post.__table__, post_rows())
+
+    echo('Building timelines')
+    Timeline.rebuild(db.session)
+    db.session.commit()
+    return users, sum(followed_count), posts
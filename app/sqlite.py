@@ -0,0 +1,52 @@
+# sqlite.py: production settings for SQLite (SQLITE_TUNED). Every connection
+# gets WAL journaling, so readers never wait for the writer, plus
+# synchronous=NORMAL, a memory map, a bigger page cache and a busy timeout.
+# SQLite allows one writer at a time, so write transactions in this process
+# take writer_lock from their first INSERT/UPDATE/DELETE until commit or
+# rollback. Threads then queue on the lock instead of spinning on "database is
+# locked", and the busy timeout only covers writers in other processes.
+import threading
+from sqlalchemy import event
+
+writer_lock = threading.RLock()
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
+
+
+def init_app(app, db):
+    engines = [db.get_engine(app)] + [db.get_engine(app, bind=key)
+                                      for key in (app.config['SQLALCHEMY_BINDS'] or {})]
+    for engine in engines:
+        if engine.dialect.name == 'sqlite':
+            tune(engine, app.config)
+
+
+def tune(engine, config):
+    pragmas = [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',  # safe with WAL, fsyncs at checkpoints instead of every commit
+        'PRAGMA mmap_size={}'.format(config['SQLITE_MMAP_SIZE']),
+        'PRAGMA cache_size={}'.format(config['SQLITE_CACHE_SIZE']),
+        'PRAGMA busy_timeout={}'.format(config['SQLITE_BUSY_TIMEOUT']),
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not conn.info.get('writer') and statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+            writer_lock.acquire()
+            conn.info['writer'] = True
+
+    def release(info):
+        if info.pop('writer', False):
+            writer_lock.release()
+
+    event.listen(engine, 'commit', lambda conn: release(conn.info))
+    event.listen(engine, 'rollback', lambda conn: release(conn.info))
+    # connections returned to the pool without commit or rollback
+    event.listen(engine, 'reset', lambda dbapi_connection, connection_record: release(connection_record.info))
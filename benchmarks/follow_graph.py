@@ -0,0 +1,110 @@
+# follow_graph.py: compares building and querying a follow graph one pair at a
+# time (follow()/is_following()) with the batched follow_many()/following_status().
+#
+#   python benchmarks/follow_graph.py --users 100 --follows 100    # 10k edges
+#   python benchmarks/follow_graph.py --database postgresql://localhost/bench
+import argparse
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from config import Config
+from app import create_app, db
+from app.models import User, followers
+
+
+class StatementCounter(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        db.event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc):
+        db.event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
+
+
+def reset_graph(users):
+    db.session.execute(followers.delete())
+    db.session.execute(User.__table__.update().values(followers_count=0, followed_count=0))
+    db.session.commit()
+    for user in users:  # reload once so lazy refreshes are not counted below
+        user.username
+
+
+def run(name, users, targets, step):
+    reset_graph(users)
+    with StatementCounter(db.engine) as counter:
+        start = perf_counter()
+        for user in users:
+            step(user, targets[user.id])
+        db.session.commit()
+        elapsed = perf_counter() - start
+    return name, elapsed, counter.count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--follows', type=int, default=100, help='users followed by each user')
+    parser.add_argument('--status-batch', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database', help='database URL, defaults to a temporary SQLite file')
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+        ELASTICSEARCH_URL = None
+        SEARCH_QUEUE_WORKERS = 0
+        LOG_TO_STDOUT = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        rng = random.Random(args.seed)
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(max(args.users, args.follows + 1))]
+        db.session.add_all(users)
+        db.session.commit()
+        targets = {user.id: rng.sample([u for u in users if u is not user], args.follows)
+                   for user in users[:args.users]}
+        active = users[:args.users]
+
+        def follow_each(user, others):
+            for other in others:
+                user.follow(other)
+
+        results = [run('follow() per pair', active, targets, follow_each),
+                   run('follow_many()', active, targets, lambda user, others: user.follow_many(others))]
+
+        batch = [u.id for u in users[:args.status_batch]]
+        with StatementCounter(db.engine) as counter:
+            start = perf_counter()
+            for user in active:
+                [user.is_following(other) for other in users[:args.status_batch]]
+            results.append(('is_following() x{}'.format(args.status_batch), perf_counter() - start, counter.count))
+        with StatementCounter(db.engine) as counter:
+            start = perf_counter()
+            for user in active:
+                user.following_status(batch)
+            results.append(('following_status()', perf_counter() - start, counter.count))
+        db.drop_all()
+
+    print('{} users following {} users each ({} edges)'.format(args.users, args.follows, args.users * args.follows))
+    print('{:<26}{:>12}{:>14}'.format('method', 'seconds', 'statements'))
+    for name, elapsed, statements in results:
+        print('{:<26}{:>12.3f}{:>14}'.format(name, elapsed, statements))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# logins.py: password verification throughput (logins per second per core)
+# for each hash method, on the request thread and through the process pool,
+# plus the cost of an attempt turned away by the login rate limiter.
+#
+#   python benchmarks/logins.py
+#   python benchmarks/logins.py --methods pbkdf2:sha256:150000 pbkdf2:sha256:600000 --workers 4
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from config import Config
+from app import create_app
+from app.passwords import PasswordHasher, LoginRateLimiter
+
+
+def measure(hasher, pwhash, logins, threads):  # logins per second with `threads` concurrent requests
+    start = perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(lambda i: hasher.verify(pwhash, 'password'), range(logins)))
+    assert all(results)
+    return logins / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--methods', nargs='+', default=['pbkdf2:sha256:150000'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='processes in the pool')
+    parser.add_argument('--logins', type=int, default=50, help='verifications per measurement')
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        ELASTICSEARCH_URL = None
+        SEARCH_QUEUE_WORKERS = 0
+        LOG_TO_STDOUT = True
+
+    app = create_app(BenchConfig)
+    cores = os.cpu_count() or 1
+    print('{} cores, pool of {} processes'.format(cores, args.workers))
+    print('{:<28}{:>14}{:>14}{:>18}'.format('method', 'inline/s', 'pool/s', 'pool/s per core'))
+    for method in args.methods:
+        app.config.update(PASSWORD_HASH_METHOD=method, PASSWORD_HASH_WORKERS=0)
+        inline = PasswordHasher(app)
+        pwhash = inline.hash('password')
+        inline_rate = measure(inline, pwhash, args.logins, 1)
+        app.config['PASSWORD_HASH_WORKERS'] = args.workers
+        pooled = PasswordHasher(app)
+        measure(pooled, pwhash, args.workers, args.workers)  # starts the processes
+        pool_rate = measure(pooled, pwhash, args.logins, args.workers * 2)
+        pooled.close()
+        print('{:<28}{:>14.1f}{:>14.1f}{:>18.1f}'.format(
+            method, inline_rate, pool_rate, pool_rate / min(args.workers, cores)))
+
+    limiter = LoginRateLimiter(app)
+    attempts = 100000
+    start = perf_counter()
+    for i in range(attempts):
+        limiter.allow('victim', '10.0.0.{}'.format(i % 256))
+    elapsed = perf_counter() - start
+    print('throttled attempts: {:.0f}/s ({:.1f}us each, no hashing)'.format(attempts / elapsed, elapsed / attempts * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# post_rows.py: compares reading one page of posts as ORM objects (Post with
+# its joined author) with the column-only read path in app/rows.py, in time
+# and in memory allocated per page (tracemalloc), for a few page sizes.
+#
+#   python benchmarks/post_rows.py
+#   python benchmarks/post_rows.py --per-page 50,500 --repeat 50
+import argparse
+import os
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from config import Config
+from app import create_app, db
+from app.models import Post
+from app.rows import post_rows, with_author_columns
+from app.seed import seed
+
+
+def orm_page(per_page):
+    posts = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(per_page).all()
+    return [(p.id, p.body, p.timestamp, p.author.username, p.author.avatar(70)) for p in posts]
+
+
+def row_page(per_page):
+    rows = post_rows(with_author_columns(Post.query).order_by(
+        Post.timestamp.desc(), Post.id.desc()).limit(per_page))
+    return [(r.id, r.body, r.timestamp, r.author.username, r.author.avatar(70)) for r in rows]
+
+
+def measure(read, per_page, repeat):  # (ms per page, KiB allocated per page)
+    read(per_page)  # warm up
+    start = perf_counter()
+    for _ in range(repeat):
+        read(per_page)
+        db.session.remove()  # a new session per page, like a request
+    elapsed = (perf_counter() - start) / repeat * 1000
+    tracemalloc.start()
+    read(per_page)
+    allocated = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    db.session.remove()
+    return elapsed, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--per-page', default='50,500', help='comma separated page sizes')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--posts', type=int, default=5000)
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+        ELASTICSEARCH_URL = None
+        SEARCH_QUEUE_WORKERS = 0
+        LOG_TO_STDOUT = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        seed(args.users, args.posts, 10, echo=lambda message: None)
+        print('{:>9}{:>12}{:>12}{:>14}{:>14}'.format('per page', 'orm ms', 'rows ms', 'orm KiB', 'rows KiB'))
+        for per_page in [int(n) for n in args.per_page.split(',')]:
+            orm_ms, orm_kib = measure(orm_page, per_page, args.repeat)
+            rows_ms, rows_kib = measure(row_page, per_page, args.repeat)
+            print('{:>9}{:>12.2f}{:>12.2f}{:>14.1f}{:>14.1f}'.format(per_page, orm_ms, rows_ms, orm_kib, rows_kib))
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
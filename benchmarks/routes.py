@@ -0,0 +1,153 @@
+# routes.py: route-level latency benchmarks. Seeds a database per data size
+# with app/seed.py, drives the views through the Flask test client and reports
+# p50/p95/p99 latency and requests per second per route.
+#
+#   python benchmarks/routes.py --sizes small,medium --output results.json
+#   python benchmarks/routes.py --output new.json --compare baseline.json --threshold 0.25
+#
+# With --compare the run exits with status 1 when the p95 latency of any route
+# grew more than --threshold (a fraction) over the baseline file.
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from config import Config
+from app import create_app, db
+from app.models import Post, User
+from app.seed import seed, WORDS
+
+SIZES = {  # users, posts, average follows per user
+    'tiny': (200, 2000, 10),
+    'small': (1000, 10000, 20),
+    'medium': (10000, 100000, 50),
+    'large': (50000, 1000000, 100),
+}
+PASSWORD = 'password'
+
+
+def percentile(timings, fraction):
+    return timings[min(int(len(timings) * fraction), len(timings) - 1)]
+
+
+def measure(requests, count, warmup):
+    # requests is a function making one request and returning the response
+    for _ in range(warmup):
+        requests()
+    timings = []
+    start = perf_counter()
+    for _ in range(count):
+        started = perf_counter()
+        response = requests()
+        timings.append((perf_counter() - started) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError('{} returned {}'.format(requests.__name__, response.status_code))
+    elapsed = perf_counter() - start
+    timings.sort()
+    return {'p50': percentile(timings, 0.50), 'p95': percentile(timings, 0.95),
+            'p99': percentile(timings, 0.99), 'rps': count / elapsed, 'requests': count}
+
+
+def bench_size(config_class, size, count, warmup, seed_value):
+    users, posts, follows = SIZES[size]
+    app = create_app(config_class)
+    results = {}
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(users, posts, follows, seed=seed_value, password=PASSWORD, echo=lambda message: None)
+        Post.reindex()  # seed() bypasses the session hooks, so search would only find empty pages
+        rng = random.Random(seed_value)
+        reader = User.query.order_by(User.followed_count.desc()).first()  # heaviest home timeline
+        usernames = [u.username for u in User.query.order_by(User.followers_count.desc()).limit(50)]
+        client = app.test_client()
+        client.post('/auth/login', data={'username': reader.username, 'password': PASSWORD})
+
+        def index():
+            return client.get('/index')
+
+        def user():
+            return client.get('/user/' + rng.choice(usernames))
+
+        def explore():
+            return client.get('/explore')
+
+        def search():
+            return client.get('/search?q=' + rng.choice(WORDS))
+
+        def login():  # fresh client each time so the login form is really processed
+            return app.test_client().post('/auth/login', data={
+                'username': rng.choice(usernames), 'password': PASSWORD})
+
+        def submit_post():
+            return client.post('/index', data={'post': ' '.join(rng.choice(WORDS) for _ in range(10))})
+
+        for route, requests in [('main.index', index), ('main.user', user), ('main.explore', explore),
+                                ('main.search', search), ('auth.login', login),
+                                ('main.index POST', submit_post)]:
+            results[route] = measure(requests, count, warmup)
+            db.session.remove()
+        app.presence.flush()
+        db.drop_all()
+    return results
+
+
+def compare(results, baseline, threshold):  # returns a list of regression messages
+    regressions = []
+    for size, routes in results.items():
+        for route, stats in routes.items():
+            before = baseline.get(size, {}).get(route)
+            if before and stats['p95'] > before['p95'] * (1 + threshold):
+                regressions.append('{} {}: p95 {:.2f}ms -> {:.2f}ms (+{:.0%})'.format(
+                    size, route, before['p95'], stats['p95'], stats['p95'] / before['p95'] - 1))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='tiny,small', help='comma separated, from: ' + ', '.join(SIZES))
+    parser.add_argument('--requests', type=int, default=100, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database', help='database URL, defaults to a temporary SQLite file')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed p95 growth, 0.25 = 25%%')
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+        ELASTICSEARCH_URL = None
+        SEARCH_QUEUE_WORKERS = 0
+        WTF_CSRF_ENABLED = False
+        LOG_TO_STDOUT = True
+        LOGIN_USERNAME_BURST = LOGIN_ADDRESS_BURST = 1000000  # every measured login comes from one client
+
+    results = {}
+    for size in args.sizes.split(','):
+        results[size] = bench_size(BenchConfig, size, args.requests, args.warmup, args.seed)
+        print('{} ({} users, {} posts, {} follows per user)'.format(size, *SIZES[size]))
+        print('  {:<18}{:>10}{:>10}{:>10}{:>10}'.format('route', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+        for route, stats in results[size].items():
+            print('  {:<18}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}{rps:>10.1f}'.format(route, **stats))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+        print('No route regressed more than {:.0%}.'.format(args.threshold))
+
+
+if __name__ == '__main__':
+    main()
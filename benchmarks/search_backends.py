@@ -0,0 +1,112 @@
+# search_backends.py: compares query latency of the database full-text search
+# (app/fulltext.py) with Elasticsearch on the same generated corpus.
+#
+#   python benchmarks/search_backends.py --posts 50000 --queries 500
+#   python benchmarks/search_backends.py --elasticsearch http://localhost:9200
+#   python benchmarks/search_backends.py --database postgresql://localhost/bench
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from elasticsearch import Elasticsearch
+from config import Config
+from app import create_app, db
+from app.models import User, Post
+from app.search import query_index
+from app.seed import EPOCH
+
+
+def make_vocabulary(rng, size):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(size)]
+
+
+def zipf_word(rng, vocabulary):  # a few words are very common, like real text
+    return vocabulary[min(int(rng.paretovariate(1.1)) - 1, len(vocabulary) - 1)]
+
+
+def seed_corpus(rng, vocabulary, posts):
+    user = User(username='bench', email='bench@example.com')
+    db.session.add(user)
+    db.session.commit()
+    start = EPOCH - timedelta(days=365)  # fixed, like app/seed.py
+    rows = []
+    for i in range(posts):
+        body = ' '.join(zipf_word(rng, vocabulary) for _ in range(rng.randint(5, 20)))[:140]
+        rows.append({'body': body, 'user_id': user.id,
+                     'timestamp': start + timedelta(seconds=rng.randint(0, 365 * 86400))})
+        if len(rows) == 5000:
+            db.session.execute(Post.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Post.__table__.insert(), rows)
+    db.session.commit()
+
+
+def measure(app, queries, per_page):
+    timings = []
+    for query in queries:
+        app.search_cache.clear()  # measure the backend, not the result cache
+        start = perf_counter()
+        query_index('post', query, 1, per_page)
+        timings.append((perf_counter() - start) * 1000)
+    timings.sort()
+    pick = lambda p: timings[min(int(len(timings) * p), len(timings) - 1)]
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99),
+            'mean': sum(timings) / len(timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--per-page', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database', help='database URL, defaults to a temporary SQLite file')
+    parser.add_argument('--elasticsearch', help='Elasticsearch URL to compare against')
+    args = parser.parse_args()
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database
+        ELASTICSEARCH_URL = None
+        SEARCH_QUEUE_WORKERS = 0
+        LOG_TO_STDOUT = True
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        rng = random.Random(args.seed)
+        vocabulary = make_vocabulary(rng, 5000)
+        seed_corpus(rng, vocabulary, args.posts)
+        queries = [' '.join(zipf_word(rng, vocabulary) for _ in range(rng.randint(1, 2)))
+                   for _ in range(args.queries)]
+
+        results = {}
+        Post.reindex()
+        results[db.get_engine().dialect.name + ' full-text'] = measure(app, queries, args.per_page)
+        if args.elasticsearch:
+            app.elasticsearch = Elasticsearch([args.elasticsearch])
+            if app.elasticsearch.indices.exists(index='post'):
+                app.elasticsearch.indices.delete(index='post')
+            Post.reindex()
+            app.elasticsearch.indices.refresh(index='post')
+            results['elasticsearch'] = measure(app, queries, args.per_page)
+        db.drop_all()
+
+    print('{} posts, {} queries, {} results per page'.format(args.posts, args.queries, args.per_page))
+    print('{:<24}{:>10}{:>10}{:>10}{:>10}'.format('backend', 'p50 ms', 'p95 ms', 'p99 ms', 'mean ms'))
+    for name, stats in results.items():
+        print('{:<24}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}{mean:>10.2f}'.format(name, **stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# sqlite_concurrency.py: load test of one SQLite file shared by several worker
+# processes, like gunicorn workers, with and without SQLITE_TUNED (WAL, tuned
+# pragmas and the per-process writer lock in app/sqlite.py). Each worker mixes
+# profile page reads with new posts and reports requests per second and
+# failed requests ("database is locked").
+#
+#   python benchmarks/sqlite_concurrency.py
+#   python benchmarks/sqlite_concurrency.py --workers 1,4,16 --seconds 10 --writes 0.2
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from config import Config
+from app import create_app, db
+from app.seed import seed, WORDS
+
+PASSWORD = 'password'
+
+
+def make_config(path, tuned):
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        SQLITE_TUNED = tuned
+        ELASTICSEARCH_URL = None
+        SEARCH_QUEUE_WORKERS = 0
+        MAIL_WORKERS = 0
+        PASSWORD_HASH_WORKERS = 0
+        WTF_CSRF_ENABLED = False
+        LOG_TO_STDOUT = True
+        LOGIN_USERNAME_BURST = LOGIN_ADDRESS_BURST = 1000000
+    return BenchConfig
+
+
+def worker(config_class, number, users, seconds, writes, results):
+    app = create_app(config_class)
+    app.logger.disabled = True  # failed requests are counted, not logged
+    rng = random.Random(number)
+    client = app.test_client()
+    client.post('/auth/login', data={'username': 'user{}'.format(number % users + 1), 'password': PASSWORD})
+    done = failed = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        if rng.random() < writes:
+            response = client.post('/index', data={'post': ' '.join(rng.choice(WORDS) for _ in range(8))})
+        else:
+            response = client.get('/user/user{}'.format(rng.randint(1, users)))
+        done += 1
+        failed += response.status_code >= 500
+    results.put((done, failed, perf_counter() - start))
+
+
+def run(tuned, workers, args):
+    path = os.path.join(tempfile.mkdtemp(), 'load.db')
+    config_class = make_config(path, tuned)
+    app = create_app(config_class)
+    with app.app_context():
+        db.create_all()
+        seed(args.users, args.posts, 10, password=PASSWORD, echo=lambda message: None)
+        db.session.remove()
+        db.get_engine(app).dispose()  # no connections shared with the forked workers
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(
+        config_class, i, args.users, args.seconds, args.writes, results)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    totals = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    done = sum(t[0] for t in totals)
+    failed = sum(t[1] for t in totals)
+    elapsed = max(t[2] for t in totals)
+    return done / elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,4,16', help='comma separated worker process counts')
+    parser.add_argument('--seconds', type=float, default=5, help='load duration per run')
+    parser.add_argument('--writes', type=float, default=0.1, help='fraction of requests that post')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=2000)
+    args = parser.parse_args()
+
+    print('{:<10}{:>10}{:>14}{:>10}'.format('mode', 'workers', 'req/s', 'failed'))
+    for tuned in (False, True):
+        for workers in [int(w) for w in args.workers.split(',')]:
+            rps, failed = run(tuned, workers, args)
+            print('{:<10}{:>10}{:>14.1f}{:>10}'.format('tuned' if tuned else 'default', workers, rps, failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,29 @@ class Config(object):
     # good practice to set configuration from environment variables
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'password123' # SECRET_KEY config variable used to generate signatures or tokens, protection against CSRF attacks
     POSTS_PER_PAGE = 3
+    POSTS_CURSOR_PAGINATION = os.environ.get('POSTS_CURSOR_PAGINATION') is not None  # use keyset pagination (app/pagination.py) for post listings, ?page=N links keep working
+
+    # materialized home timeline (see Timeline in app/models.py)
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)  # newest entries kept per user
+    TIMELINE_CELEBRITY_THRESHOLD = int(os.environ.get('TIMELINE_CELEBRITY_THRESHOLD') or 10000)  # authors with more followers are read on demand instead of fanned out
+
+    # buffered last_seen tracking (app/presence.py)
+    LAST_SEEN_GRANULARITY = 60  # seconds, a user's last_seen is only updated when older than this
+    LAST_SEEN_FLUSH_INTERVAL = 30  # seconds between batched writes
+    LAST_SEEN_MAX_PENDING = 1000  # write early when this many users are buffered
 
     # set to DATABASE_URL environment variable
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')  # backup that configures a databas named 'app.db' in parent directory (basedir)
+    # read replicas, comma separated URLs. Reads in GET requests are spread over
+    # them, writes and everything after a user's own write go to the primary
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if uri]
+    DATABASE_STICKY_SECONDS = 5  # how long a user's reads stay on the primary after they wrote
+    # SQLite production mode (app/sqlite.py): WAL journaling and tuned pragmas
+    SQLITE_TUNED = os.environ.get('SQLITE_TUNED') is not None
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # bytes of the database file read through a memory map
+    SQLITE_CACHE_SIZE = -64000  # page cache, negative values are in KiB
+    SQLITE_BUSY_TIMEOUT = 5000  # milliseconds a writer waits for another process's write to finish
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # disables tracking changes
 
     # set-up emailing errors and email password reset functionality
@@ -21,9 +40,74 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['yoonphilip99@gmail.com']
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)  # threads sending queued mail, 0 sends on the request thread
+    MAIL_QUEUE_SIZE = 1000  # messages waiting to be sent
+    MAIL_QUEUE_TIMEOUT = 1  # seconds send_email waits for room in a full queue before dropping the message
+    MAIL_IDLE_TIMEOUT = 5  # seconds a worker keeps its SMTP connection open with nothing to send
+    MAIL_MAX_ATTEMPTS = 5  # failed messages are retried with backoff this many times
+    MAIL_RETRY_BACKOFF = 1  # seconds before the first retry, doubled for each one after
 
     # connection with Elasticsearch service
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    ELASTICSEARCH_BULK_SIZE = int(os.environ.get('ELASTICSEARCH_BULK_SIZE') or 500)  # operations per _bulk request (queue drains and reindex)
+    ELASTICSEARCH_SHARDS = int(os.environ.get('ELASTICSEARCH_SHARDS') or 1)  # settings of indexes created by `flask search reindex`
+    ELASTICSEARCH_REPLICAS = int(os.environ.get('ELASTICSEARCH_REPLICAS') or 1)
+    ELASTICSEARCH_TRACK_TOTAL_HITS = 1000  # searches stop counting matches here, the page links only need to know there are more
+    ELASTICSEARCH_MAX_FROM = 1000  # deeper pages opened without the page before them skip ahead with search_after
+    SEARCH_QUEUE_WORKERS = int(os.environ.get('SEARCH_QUEUE_WORKERS') or 2)  # background threads draining the search_queue table, 0 leaves it to `flask search drain`
+    SEARCH_QUEUE_POLL_INTERVAL = 5  # seconds idle workers wait before checking the queue again
+    SEARCH_QUEUE_MAX_ATTEMPTS = 10  # failed operations are retried with backoff this many times
+    SEARCH_QUEUE_LEASE = 60  # seconds a drain owns the rows it claimed, then they are due again
+    SEARCH_CACHE_URL = os.environ.get('SEARCH_CACHE_URL')  # redis:// URL to share cached search pages between processes, in-process LRU if unset
+    SEARCH_CACHE_SIZE = 1024  # cached pages kept by the in-process LRU
+    SEARCH_CACHE_TTL = 60  # seconds a cached page is served
+
+    # rendered post rows (app/fragments.py)
+    FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL')  # redis:// URL to share rendered rows between processes, in-process LRU if unset
+    FRAGMENT_CACHE_SIZE = 4096  # rows kept by the in-process LRU
+    FRAGMENT_CACHE_TTL = 24 * 3600  # seconds a row is kept, rows of posts nobody reads age out of a shared cache
+
+    RECENT_POSTS_SIZE = int(os.environ.get('RECENT_POSTS_SIZE') or 500)  # newest posts kept in memory for the first pages of /explore
+    RECENT_POSTS_MAX_AGE = 10  # seconds before the buffer is reloaded to pick up posts made by other processes
+
+    USER_CACHE_URL = os.environ.get('USER_CACHE_URL')  # redis:// URL to share cached logged-in users between processes, in-process LRU if unset
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 30  # seconds, commits to a user row drop its entry right away
+
+    # password hashing, werkzeug method string where the iteration count is the cost.
+    # hashes made with another method are upgraded on the next successful login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)  # processes verifying passwords, 0 verifies on the request thread
+    PASSWORD_HASH_QUEUE_PER_WORKER = 4  # checks allowed to wait for a worker, further logins are turned away
+    PASSWORD_HASH_TIMEOUT = 2  # seconds a login waits for a free slot
+    LOGIN_USERNAME_BURST = 5  # login attempts per username before throttling
+    LOGIN_USERNAME_PER_MINUTE = 5  # then this many per minute
+    LOGIN_ADDRESS_BURST = 30  # same, per client address
+    LOGIN_ADDRESS_PER_MINUTE = 30
+    # address buckets are only kept when client addresses can be told apart: with
+    # PROXY_FIX_X_FOR set, or with this set when clients reach the app directly.
+    # Behind a proxy that isn't declared every client has the proxy's address,
+    # and one address bucket would lock everybody out
+    LOGIN_LIMIT_BY_ADDRESS = os.environ.get('LOGIN_LIMIT_BY_ADDRESS') is not None
+    LOGIN_RATE_LIMIT_KEYS = 100000  # buckets kept before refilled ones are pruned
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR') or 0)  # proxies in front of the app (1 on Heroku), client addresses are then read from X-Forwarded-For
+
+    # per-request SQL/search/render timings and /metrics (app/instrumentation.py)
+    INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION_ENABLED') is not None
+    INSTRUMENTATION_SLOW_STATEMENTS = 3  # slowest statements included in the request log line
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # scrapers send it as "Authorization: Bearer <token>"
+    # comma separated client addresses that may scrape without the token, none by default:
+    # behind a local proxy every request comes from 127.0.0.1 unless PROXY_FIX_X_FOR is set
+    METRICS_ALLOWED_ADDRESSES = [address for address in (os.environ.get('METRICS_ALLOWED_ADDRESSES') or '').split(',') if address]
+    METRICS_QUEUE_TTL = 15  # seconds the search queue gauges are reused between scrapes
 
     # specify log to stdout for heroku
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_DIR = os.environ.get('LOG_DIR') or 'logs'
+    LOG_ROTATE_BYTES = int(os.environ.get('LOG_ROTATE_BYTES') or 10 * 1024 * 1024)  # size based rotation
+    LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN')  # e.g. 'midnight' to rotate by time instead of size
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_COMPRESS = os.environ.get('LOG_COMPRESS') is not None  # gzip rotated files
+    LOG_MAIL_INTERVAL = 300  # seconds, at most one error mail digest per interval
+    LOG_MAIL_MAX_RECORDS = 50  # errors included in one digest, the rest are only counted
@@ -1,7 +1,8 @@
-from app import create_app, db
+from app import create_app, db, cli
 from app.models import User, Post
 
 app = create_app()
+cli.register(app)  # adds the custom `flask` commands in app/cli.py
 
 @app.shell_context_processor
 def make_shell_context():
@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 import logging
+from fnmatch import fnmatch
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -27,6 +28,15 @@ config.set_main_option(
     str(current_app.extensions['migrate'].db.engine.url).replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+
+
+# the full-text search tables and indexes are made by app/fulltext.py, not by
+# the models: <index>_fts and its FTS5 shadow tables (<index>_fts_data, ...) on
+# SQLite, the ix_<index>_fts expression index on PostgreSQL. Autogenerate
+# would otherwise emit drop_table/drop_index for them
+def include_object(object, name, type_, reflected, compare_to):
+    return not (type_ in ('table', 'index') and fnmatch(name, '*_fts*'))
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -47,7 +57,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -83,6 +94,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
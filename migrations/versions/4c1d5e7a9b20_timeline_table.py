@@ -0,0 +1,42 @@
+"""timeline table
+
+Revision ID: 4c1d5e7a9b20
+Revises: b3b4f9593c9c
+Create Date: 2026-10-18 09:12:41.318520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c1d5e7a9b20'
+down_revision = 'b3b4f9593c9c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline', ['user_id', 'timestamp'], unique=False)
+
+    # backfill existing timelines: own posts plus posts of followed users
+    # (not capped, the next post from a followed user trims them)
+    op.execute('INSERT INTO timeline (user_id, post_id, timestamp) '
+               'SELECT post.user_id, post.id, post.timestamp FROM post')
+    op.execute('INSERT INTO timeline (user_id, post_id, timestamp) '
+               'SELECT DISTINCT followers.follower_id, post.id, post.timestamp '
+               'FROM followers JOIN post ON post.user_id = followers.followed_id '
+               'WHERE followers.follower_id != post.user_id')
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.drop_table('timeline')
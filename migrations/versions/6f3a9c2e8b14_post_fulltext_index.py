@@ -0,0 +1,35 @@
+"""post full-text index
+
+Revision ID: 6f3a9c2e8b14
+Revises: 1b8e6f2d4a57
+Create Date: 2026-10-18 12:21:44.730192
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f3a9c2e8b14'
+down_revision = '1b8e6f2d4a57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # database full-text index used by app/fulltext.py when Elasticsearch isn't configured
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)')
+        op.execute('INSERT INTO post_fts (rowid, body) SELECT id, body FROM post')
+    elif dialect == 'postgresql':
+        op.execute("CREATE INDEX IF NOT EXISTS ix_post_fts ON post "
+                   "USING gin (to_tsvector('english', coalesce(body, '')))")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS post_fts')
+    elif dialect == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_post_fts')
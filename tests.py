@@ -1,33 +1,201 @@
+import fnmatch
+import gzip
+import json
+import logging
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
 import unittest
 from datetime import datetime, timedelta
+from flask import _request_ctx_stack
 from config import Config
 from app import create_app, db
-from app.models import User, Post
+from app.models import User, Post, SearchQueue, followers, timeline, load_user
+from app.seed import seed
+from app.pagination import paginate_by_cursor, decode_cursor
+from app.logs import LogPipeline, BatchingSMTPHandler
+from app.emails import send_email
+from app.passwords import PasswordHasher
+from app.sqlite import writer_lock
+from app.rows import PostRow, post_rows, with_author_columns
+from app.search import bulk_index, create_index
+from werkzeug.security import generate_password_hash
 
 class TestConfig(Config):
     TESTING = True  # config variable to check if app is testing or not
-    SQLALCHEMY_DATABASE_URI = 'sqlite://'\
-    ELASTICSEARCH_UR = None
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    ELASTICSEARCH_URL = None
+    WTF_CSRF_ENABLED = False  # lets the test client post forms
+    SEARCH_QUEUE_WORKERS = 0  # tests drain the search queue explicitly
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'  # cheap hashes keep the tests fast
+    PASSWORD_HASH_WORKERS = 0
+    LOG_TO_STDOUT = None  # the logging tests write files, whatever the environment says
+
+class FakeElasticsearch(object):
+    # local stand-in for the Elasticsearch client, records every request made
+    def __init__(self):
+        self.indexes = {}
+        self.aliases = {}  # alias -> set of index names
+        self.requests = []
+        self.indices = FakeIndices(self)
+
+    def resolve(self, name):  # index names behind an alias or index name
+        return sorted(self.aliases.get(name) or [name])
+
+    def index(self, index, id, body):
+        self.requests.append(('index', index))
+        self.indexes.setdefault(self.resolve(index)[0], {})[str(id)] = body
+
+    def delete(self, index, id):
+        self.requests.append(('delete', index))
+        self.indexes.get(self.resolve(index)[0], {}).pop(str(id), None)
+
+    def bulk(self, body):
+        self.requests.append(('bulk', len(body)))
+        items = []
+        lines = iter(body)
+        for line in lines:
+            (action, meta), = line.items()
+            docs = self.indexes.setdefault(self.resolve(meta['_index'])[0], {})
+            id = str(meta['_id'])
+            if action == 'delete':
+                items.append({action: {'status': 200 if docs.pop(id, None) else 404}})
+            elif action == 'create' and id in docs:
+                next(lines)
+                items.append({action: {'status': 409, 'error': {'type': 'version_conflict_engine_exception'}}})
+            else:
+                docs[id] = next(lines)
+                items.append({action: {'status': 201}})
+        return {'errors': any('error' in list(item.values())[0] for item in items), 'items': items}
+
+    def search(self, index, body, filter_path=None):
+        # every hit scores the same, so hits are sorted by id
+        self.requests.append(('search', index))
+        query = body['query']['multi_match']['query'].lower()
+        fields = body['query']['multi_match']['fields']
+        ids = sorted(int(id) for name in self.resolve(index) for id, doc in self.indexes.get(name, {}).items()
+                     if any(query in str(value).lower() for field, value in doc.items()
+                            if field in fields or fields == ['*']))
+        total, cap = len(ids), body['track_total_hits']
+        if 'search_after' in body:
+            ids = [id for id in ids if id > body['search_after'][1]]
+        start = body.get('from', 0)
+        hits = [{'_id': str(id), 'sort': [1.0, id]} for id in ids[start:start + body['size']]]
+        return {'hits': {'hits': hits, 'total': {'value': min(total, cap or total),
+                                                 'relation': 'gte' if cap and total > cap else 'eq'}}}
+
+class FakeIndices(object):
+    def __init__(self, es):
+        self.es = es
+
+    def create(self, index, body):
+        self.es.requests.append(('create', index))
+        self.es.indexes[index] = {}
+        self.body = body
+        for alias in body.get('aliases', {}):
+            self.es.aliases.setdefault(alias, set()).add(index)
+
+    def delete(self, index):
+        self.es.requests.append(('delete_index', index))
+        del self.es.indexes[index]
+
+    def exists(self, index):
+        return index in self.es.indexes or bool(self.es.aliases.get(index))
+
+    def exists_alias(self, name):
+        return bool(self.es.aliases.get(name))
+
+    def get_alias(self, index):
+        return {name: {'aliases': {alias: {} for alias, names in self.es.aliases.items() if name in names}}
+                for name in self.es.indexes if fnmatch.fnmatch(name, index)}
+
+    def put_settings(self, index, body):
+        pass
+
+    def refresh(self, index):
+        pass
+
+    def update_aliases(self, body):  # applied all at once, like Elasticsearch does
+        self.es.requests.append(('update_aliases', len(body['actions'])))
+        for action in body['actions']:
+            (kind, args), = action.items()
+            if kind == 'add':
+                self.es.aliases.setdefault(args['alias'], set()).add(args['index'])
+            elif kind == 'remove':
+                self.es.aliases[args['alias']].discard(args['index'])
+            else:
+                del self.es.indexes[args['index']]
+                for names in self.es.aliases.values():
+                    names.discard(args['index'])
+
+class AppTestCase(unittest.TestCase):
+    # Python unittest allows you to define setUp() and tearDown() methods which gets performed before and after each test method.
+    # Every test gets an app from make_config() with a pushed app context, fresh tables and a test client
+    def make_config(self):  # tests needing their own settings (files, ports) return a TestConfig subclass
+        return TestConfig
 
-class UserModelTest(unittest.TestCase):
-    # Python unittest allows you to define setUp() and tearDown() methods which gets performed before and after each test method
     def setUp(self):
-        self.app = create_app(TestConfig)
-        self.app_context = self.app.app_context
+        self.app = create_app(self.make_config())
+        self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()  # create all database table
+        self.client = self.app.test_client()
 
     def tearDown(self):
         db.session.remove()  # in config.py SQLALCHEMY_COMMIT_ON_TEARDOWN is set to True, so if not for calling this function changes would be auto-committed
         db.drop_all()
         self.app_context.pop()
 
+    def login(self, username, password='password'):  # creates the user if needed and logs in through the login form
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            user = User(username=username, email='{}@email.com'.format(username))
+            user.set_password(password)
+            db.session.add(user)
+            db.session.commit()
+        self.client.post('/auth/login', data={'username': username, 'password': password})
+        return user
+
+class UserModelTest(AppTestCase):
     def test_password_hashing(self):
         philip = User(username='philip')
         philip.set_password('angel')
         self.assertFalse(philip.check_password('dog'))  # check to make sure wrong password is checked correctly
         self.assertTrue(philip.check_password('angel'))  # check to make sure correct password is checked correctly
 
+    def test_password_rehash_on_login(self):
+        philip = User(username='philip')
+        philip.password_hash = generate_password_hash('angel', 'pbkdf2:sha256:1')  # legacy cost
+        old_hash = philip.password_hash
+        self.assertFalse(philip.check_password('dog'))
+        self.assertEqual(philip.password_hash, old_hash)  # only upgraded after a successful check
+        self.assertTrue(philip.check_password('angel'))
+        self.assertTrue(philip.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(philip.check_password('angel'))
+
+    def test_password_pool(self):
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        hasher = PasswordHasher(self.app)
+        pwhash = hasher.hash('angel')
+        try:
+            self.assertTrue(hasher.verify(pwhash, 'angel'))
+            self.assertFalse(hasher.verify(pwhash, 'dog'))
+            self.assertIsNotNone(hasher.pool)  # checked in the worker process
+        finally:
+            hasher.close()
+
+    def test_avatar(self):
+        u = User(username='john', email='John@example.com')
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')  # md5 of lowercased email
+        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
+                                         'd4c74594d841139328695756648b6bd6'
+                                         '?d=identicon&s=128'))
+        u.email = 'susan@example.com'  # digest follows email changes
+        self.assertEqual(u.avatar_hash, 'f3fc30174d7fd74ab6ca3c36d198fcb9')
+        self.assertIn(u.avatar_hash, u.avatar(70))
+
     def test_follow(self):
         john = User(username='john', email='john@email.com')
         peter = User(username='peter', email='peter@email.com')
@@ -45,6 +213,8 @@ class UserModelTest(unittest.TestCase):
         self.assertEqual(john.followed.first().username, 'peter')
         self.assertEqual(peter.followers.count(), 1)
         self.assertEqual(peter.followers.first().username, 'john')
+        self.assertEqual((john.followed_count, john.followers_count), (1, 0))
+        self.assertEqual((peter.followed_count, peter.followers_count), (0, 1))
 
         # check unfollowing works
         john.unfollow(peter)
@@ -52,6 +222,79 @@ class UserModelTest(unittest.TestCase):
         self.assertFalse(john.is_following(peter))
         self.assertEqual(john.followed.count(), 0)
         self.assertEqual(peter.followers.count(), 0)
+        self.assertEqual((john.followed_count, peter.followers_count), (0, 0))
+
+    def test_follow_many(self):
+        john = User(username='john', email='john@email.com')
+        others = [User(username='user{}'.format(i), email='user{}@email.com'.format(i))
+                  for i in range(12)]
+        db.session.add_all([john] + others)
+        db.session.add_all([Post(body="post from {}".format(u.username), author=u) for u in others])
+        db.session.commit()
+        john.follow(others[0])
+        db.session.commit()
+        [u.username for u in [john] + others]  # load the expired objects before counting
+
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(john.follow_many(others[:3]), 2)  # others[0] was already followed
+        few = len(statements)
+        self.assertEqual(john.follow_many(others), 9)
+        self.assertEqual(len(statements), 2 * few)  # same number of statements for more users
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        db.session.commit()
+
+        self.assertEqual(john.followed.count(), 12)
+        self.assertEqual(john.followed_count, 12)
+        self.assertEqual([u.followers_count for u in others], [1] * 12)
+        self.assertEqual(len(john.timeline_posts().all()), 12)
+        status = john.following_status([others[0].id, john.id])
+        self.assertEqual(status, {others[0].id: True, john.id: False})
+
+        self.assertEqual(john.unfollow_many(others[:6] + [john]), 6)
+        db.session.commit()
+        self.assertEqual(john.followed_count, 6)
+        self.assertEqual(others[0].followers_count, 0)
+        self.assertFalse(john.is_following(others[0]))
+        self.assertEqual(len(john.timeline_posts().all()), 6)
+        self.assertEqual(User.verify_follow_counts(), [])
+
+    def test_seed(self):
+        users, follows, posts = seed(30, 200, 5, days=10, seed=1, echo=lambda message: None)
+        self.assertEqual((User.query.count(), Post.query.count()), (30, 200))
+        self.assertEqual(len(db.session.query(followers).all()), follows)
+        self.assertEqual(User.verify_follow_counts(), [])
+        for user in User.query.limit(5):  # rebuilt timelines match the followed posts query
+            self.assertEqual(user.timeline_posts().all(), user.followed_posts().all())
+
+        # same seed, same data, whenever it runs
+        posts = [(p.body, p.timestamp) for p in Post.query.order_by(Post.id)]
+        last_seen = [u.last_seen for u in User.query.order_by(User.id)]
+        db.drop_all()
+        db.create_all()
+        seed(30, 200, 5, days=10, seed=1, echo=lambda message: None)
+        self.assertEqual([(p.body, p.timestamp) for p in Post.query.order_by(Post.id)], posts)
+        self.assertEqual([u.last_seen for u in User.query.order_by(User.id)], last_seen)
+
+    def test_verify_follow_counts(self):
+        john = User(username='john', email='john@email.com')
+        peter = User(username='peter', email='peter@email.com')
+        db.session.add_all([john, peter])
+        db.session.commit()
+        john.follow(peter)
+        peter.follow(john)
+        db.session.commit()
+        self.assertEqual(User.verify_follow_counts(), [])
+
+        # counters that drifted are reported and fixed
+        peter.followers_count = 5
+        db.session.commit()
+        drift = User.verify_follow_counts(fix=True)
+        self.assertEqual(drift, [(peter, 5, 1, 1, 1)])
+        self.assertEqual(peter.followers_count, 1)
+        self.assertEqual(User.verify_follow_counts(), [])
 
     def test_follow_posts(self):
         # create four users
@@ -91,5 +334,994 @@ class UserModelTest(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+        # check the materialized timeline matches the followed posts query
+        self.assertEqual(u1.timeline_posts().all(), f1)
+        self.assertEqual(u2.timeline_posts().all(), f2)
+        self.assertEqual(u3.timeline_posts().all(), f3)
+        self.assertEqual(u4.timeline_posts().all(), f4)
+
+        # check new posts are pushed to followers and unfollowing removes them
+        p5 = Post(body="another post from david", author=u4,
+                  timestamp=now + timedelta(seconds=5))
+        db.session.add(p5)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p5, p2, p4, p1])
+        self.assertEqual(u3.timeline_posts().all(), [p5, p3, p4])
+        u1.unfollow(u4)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p2, p1])
+
+        # check following yourself doesn't duplicate or drop own posts
+        u4.follow(u4)
+        db.session.commit()
+        p6 = Post(body="david talking to himself", author=u4,
+                  timestamp=now + timedelta(seconds=6))
+        db.session.add(p6)
+        db.session.commit()
+        self.assertEqual(u4.timeline_posts().all(), [p6, p5, p4])
+        u4.unfollow(u4)
+        db.session.commit()
+        self.assertEqual(u4.timeline_posts().all(), [p6, p5, p4])
+
+    def test_delete_fanned_out_post(self):
+        db.session.execute('PRAGMA foreign_keys=ON')  # enforced like PostgreSQL does
+        u1 = User(username='john', email='john@email.com')
+        u2 = User(username='susan', email='susan@email.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        p = Post(body="post from susan", author=u2)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p])
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [])
+        self.assertEqual(db.session.query(timeline).count(), 0)
+
+    def test_timeline_length_and_celebrities(self):
+        self.app.config['TIMELINE_LENGTH'] = 2
+        u1 = User(username='john', email='john@email.com')
+        u2 = User(username='susan', email='susan@email.com')
+        u3 = User(username='mary', email='mary@email.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # check the timeline is capped to the newest entries
+        now = datetime.utcnow()
+        posts = [Post(body="post {}".format(i), author=u2,
+                      timestamp=now + timedelta(seconds=i)) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [posts[3], posts[2]])
+
+        # check celebrity posts are not fanned out but still show up
+        self.app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 1
+        u3.follow(u2)
+        db.session.commit()
+        p = Post(body="celebrity post", author=u2, timestamp=now + timedelta(seconds=9))
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all()[0], p)
+        self.assertEqual(u3.timeline_posts().all()[0], p)
+
+    def test_celebrity_threshold_crossing(self):
+        self.app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 1
+        author = User(username='susan', email='susan@email.com')
+        f1 = User(username='john', email='john@email.com')
+        f2 = User(username='mary', email='mary@email.com')
+        f3 = User(username='david', email='david@email.com')
+        db.session.add_all([author, f1, f2, f3])
+        db.session.commit()
+        f1.follow(author)
+        db.session.commit()
+        now = datetime.utcnow()
+        p1 = Post(body="fanned out", author=author, timestamp=now)
+        db.session.add(p1)
+        db.session.commit()
+
+        # check posts made above the threshold are read on demand
+        f2.follow(author)
+        f3.follow(author)
+        db.session.commit()
+        p2 = Post(body="read on demand", author=author, timestamp=now + timedelta(seconds=1))
+        db.session.add(p2)
+        db.session.commit()
+        stored = db.session.query(timeline.c.post_id).filter(timeline.c.user_id == f1.id)
+        self.assertEqual([id for id, in stored], [p1.id])
+        for user in (f1, f2, f3):
+            self.assertEqual(user.timeline_posts().all(), [p2, p1])
+
+        f2.unfollow(author)  # still above the threshold
+        db.session.commit()
+        self.assertEqual(f1.timeline_posts().all(), [p2, p1])
+
+        # check they are fanned out once the author is back at the threshold,
+        # also to followers whose backfill skipped the author
+        f1.unfollow_many([author])
+        db.session.commit()
+        self.assertEqual(f3.timeline_posts().all(), f3.followed_posts().all())
+        self.assertEqual(f3.timeline_posts().all(), [p2, p1])
+        self.assertEqual(f1.timeline_posts().all(), [])
+
+    def test_post_rows(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=u1 if i % 2 else u2,
+                                 timestamp=now + timedelta(seconds=i)) for i in range(4)])
+        u1.follow(u2)
+        db.session.commit()
+        db.session.execute(User.__table__.update().where(User.id == u2.id).values(avatar_hash=None))  # not backfilled
+        db.session.commit()
+        expected = [(p.id, p.body, p.author.username, p.author.avatar(36)) for p in u1.followed_posts()]
+        self.assertNotIn('None', ' '.join(avatar for id, body, username, avatar in expected))
+        db.session.expunge_all()
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        john = User.query.get(u1.id)
+        rows = post_rows(with_author_columns(john.followed_posts()))
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual([(r.id, r.body, r.author.username, r.author.avatar(36)) for r in rows], expected)
+        self.assertEqual(len(statements), 2)  # the user, then posts joined with their authors
+        self.assertTrue(all(isinstance(r, PostRow) for r in rows))
+        self.assertIs(rows[0].author, rows[2].author)  # one AuthorRow per author
+        self.assertEqual(list(db.session.identity_map.values()), [john])  # no Post or author objects
+
+    def test_cursor_pagination(self):
+        u = User(username='john', email='john@email.com')
+        now = datetime.utcnow()
+        posts = [Post(body="post {}".format(i), author=u,
+                      timestamp=now + timedelta(seconds=i // 2)) for i in range(5)]  # pairs share a timestamp
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        newest_first = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+
+        # walk forward through all pages
+        page = paginate_by_cursor(u.posts, None, 2)
+        self.assertEqual(page.items, newest_first[:2])
+        self.assertFalse(page.has_prev)
+        page = paginate_by_cursor(u.posts, page.next_cursor, 2)
+        self.assertEqual(page.items, newest_first[2:4])
+        page = paginate_by_cursor(u.posts, page.next_cursor, 2)
+        self.assertEqual(page.items, newest_first[4:])
+        self.assertFalse(page.has_next)
+
+        # and back again
+        page = paginate_by_cursor(u.posts, page.prev_cursor, 2)
+        self.assertEqual(page.items, newest_first[2:4])
+        page = paginate_by_cursor(u.posts, page.prev_cursor, 2)
+        self.assertEqual(page.items, newest_first[:2])
+        self.assertFalse(page.has_prev)
+
+        # check union queries and bad tokens
+        page = paginate_by_cursor(u.timeline_posts(), page.next_cursor, 2)
+        self.assertEqual(page.items, newest_first[2:4])
+        self.assertIsNone(decode_cursor('not a cursor'))
+        self.assertEqual(paginate_by_cursor(u.posts, 'garbage', 2).items, newest_first[:2])
+
+class SearchTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.elasticsearch = FakeElasticsearch()
+
+    def test_commit_queues_and_drain_sends_one_bulk_request(self):
+        u = User(username='john', email='john@email.com')
+        posts = [Post(body="post {}".format(i), author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        self.assertEqual(self.app.elasticsearch.requests, [])  # nothing sent while committing
+        self.assertEqual(SearchQueue.depth()['pending'], 3)
+        self.assertEqual(SearchQueue.drain(), 3)
+        # the first write creates the mapped index behind the post alias
+        self.assertEqual(self.app.elasticsearch.requests, [('create', 'post_v1'), ('bulk', 6)])
+        self.assertEqual(self.app.elasticsearch.aliases, {'post': {'post_v1'}})
+        self.assertEqual(sorted(self.app.elasticsearch.indexes['post_v1']),
+                         sorted(str(p.id) for p in posts))
+        self.assertEqual(SearchQueue.depth()['pending'], 0)
+
+        # repeated updates to the same post are coalesced
+        posts[0].body = 'edit 1'
+        db.session.commit()
+        posts[0].body = 'edited'
+        db.session.delete(posts[1])
+        u.about_me = 'not searchable'
+        db.session.commit()
+        self.assertEqual(SearchQueue.drain(), 3)
+        self.assertEqual(self.app.elasticsearch.requests[2:], [('bulk', 3)])
+        self.assertEqual(self.app.elasticsearch.indexes['post_v1'][str(posts[0].id)], {'id': posts[0].id, 'body': 'edited'})
+        self.assertNotIn(str(posts[1].id), self.app.elasticsearch.indexes['post_v1'])
+
+        SearchQueue.drain()
+        results, total = Post.search('edited', 1, 10)
+        self.assertEqual(total, 1)
+        self.assertEqual(results.all(), [posts[0]])
+
+    def test_drain_invalidates_cached_pages_after_refresh(self):
+        u = User(username='john', email='john@email.com')
+        db.session.add_all([u, Post(body="fox", author=u)])
+        db.session.commit()
+        generation = self.app.search_cache.counter('post')
+        refreshed = []
+        self.app.elasticsearch.indices.refresh = lambda index: refreshed.append(
+            (index, self.app.search_cache.counter('post')))
+        SearchQueue.drain()
+        self.assertEqual(refreshed, [('post', generation)])
+        self.assertEqual(self.app.search_cache.counter('post'), generation + 1)
+
+    def test_search_cache(self):
+        u = User(username='john', email='john@email.com')
+        db.session.add_all([u, Post(body="hello world", author=u)])
+        db.session.commit()
+        SearchQueue.drain()
+        requests = self.app.elasticsearch.requests
+
+        # the same normalized query is only sent once
+        self.assertEqual(Post.search('hello', 1, 10)[1], 1)
+        self.assertEqual(Post.search('  HELLO ', 1, 10)[1], 1)
+        self.assertEqual(requests.count(('search', 'post')), 1)
+        self.assertEqual(self.app.search_cache.stats()['hits'], 1)
+
+        # a commit touching the index drops cached pages
+        db.session.add(Post(body="hello again", author=u))
+        db.session.commit()
+        SearchQueue.drain()
+        self.assertEqual(Post.search('hello', 1, 10)[1], 2)
+        self.assertEqual(requests.count(('search', 'post')), 2)
+
+    def test_failed_drain_is_retried(self):
+        u = User(username='john', email='john@email.com')
+        db.session.add_all([u, Post(body="post", author=u)])
+        db.session.commit()
+
+        def unavailable(body):
+            raise ConnectionError('elasticsearch is down')
+        self.app.elasticsearch.bulk = unavailable
+        self.assertEqual(SearchQueue.drain(), 0)
+        row = SearchQueue.query.one()
+        self.assertEqual(row.attempts, 1)
+        self.assertGreater(row.available_at, datetime.utcnow())
+        self.assertEqual(SearchQueue.depth()['retrying'], 1)
+
+        # not due yet, then sent once the backoff has passed
+        del self.app.elasticsearch.bulk
+        self.assertEqual(SearchQueue.drain(), 0)
+        row.available_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(SearchQueue.drain(), 1)
+        self.assertEqual(len(self.app.elasticsearch.indexes['post_v1']), 1)
+
+    def test_claimed_rows_are_not_drained_twice(self):
+        u = User(username='john', email='john@email.com')
+        p = Post(body="post", author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+
+        # rows claimed by a drain in another process, and a newer change to
+        # the same post, wait until that claim is done or its lease ran out
+        self.assertEqual(len(SearchQueue.claim(10)), 1)
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(SearchQueue.drain(), 0)
+        self.assertEqual(self.app.elasticsearch.requests, [])
+        SearchQueue.query.update({'available_at': datetime.utcnow()})
+        db.session.commit()
+        self.assertEqual(SearchQueue.drain(), 2)
+        self.assertEqual(self.app.elasticsearch.requests, [])  # coalesced into a delete, with no index to delete from
+
+    def test_rejected_operations_are_retried(self):
+        u = User(username='john', email='john@email.com')
+        posts = [Post(body="post {}".format(i), author=u) for i in range(2)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+
+        def throttled(body):  # the second operation is rejected, the request itself succeeds
+            return {'errors': True, 'items': [{'index': {'status': 201}},
+                                              {'index': {'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}}]}
+        self.app.elasticsearch.bulk = throttled
+        self.assertEqual(SearchQueue.drain(), 1)
+        row = SearchQueue.query.one()
+        self.assertEqual((row.object_id, row.attempts), (posts[1].id, 1))
+
+    def test_reindex_in_chunks(self):
+        u = User(username='john', email='john@email.com')
+        db.session.add_all([u] + [Post(body="post {}".format(i), author=u) for i in range(5)])
+        db.session.commit()
+        es = self.app.elasticsearch = FakeElasticsearch()
+        self.assertEqual(Post.reindex(chunk_size=2), 5)
+        self.assertEqual(es.requests, [('create', 'post_v1'), ('bulk', 4), ('bulk', 4), ('bulk', 2),
+                                       ('update_aliases', 2)])
+        self.assertEqual(len(es.indexes['post_v1']), 5)
+        self.assertEqual(es.aliases, {'post': {'post_v1'}, 'post-next': set()})
+
+        # explicit mapping from __searchable__, nothing left to dynamic mapping
+        mappings = es.indices.body['mappings']
+        self.assertEqual(mappings['dynamic'], 'strict')
+        self.assertEqual(mappings['properties']['id'], {'type': 'long'})
+        self.assertEqual(mappings['properties']['body']['analyzer'], 'searchable_text')
+        self.assertIn('searchable_text', es.indices.body['settings']['analysis']['analyzer'])
+
+    def test_reindex_swaps_alias(self):
+        u = User(username='john', email='john@email.com')
+        posts = [Post(body="post {}".format(i), author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        es = self.app.elasticsearch
+        es.indexes['post'] = {}  # an index named post, from before indexes were versioned
+        SearchQueue.drain()
+        self.assertEqual(len(es.indexes['post']), 3)
+        self.assertEqual(Post.reindex(), 3)
+        self.assertEqual(sorted(es.indexes), ['post_v1'])
+        self.assertEqual(Post.search('post', 1, 10)[1], 3)
+
+        # while post_v2 is built, searches use post_v1 and changes go to both
+        name = create_index(Post)
+        self.assertEqual(name, 'post_v2')
+        posts[0].body = 'changed'
+        db.session.commit()
+        SearchQueue.drain()
+        self.assertEqual(es.indexes['post_v1'][str(posts[0].id)]['body'], 'changed')
+        self.assertEqual(es.indexes['post_v2'], {str(posts[0].id): {'id': posts[0].id, 'body': 'changed'}})
+        self.assertEqual(Post.search('post', 1, 10)[1], 2)
+
+        # an unfinished rebuild is dropped by the next one, which replaces post_v1
+        self.assertEqual(Post.reindex(), 3)
+        self.assertEqual(sorted(es.indexes), ['post_v3'])
+        self.assertEqual(es.aliases['post'], {'post_v3'})
+        self.assertEqual(Post.search('changed', 1, 10)[1], 1)
+
+    def test_reindex_keeps_changes_drained_while_building(self):
+        u = User(username='john', email='john@email.com')
+        posts = [Post(body="post {}".format(i), author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        SearchQueue.drain()
+        es = self.app.elasticsearch
+        bulk = es.bulk
+
+        def change_during_rebuild(body):  # runs between reading a chunk and sending it
+            if 'create' in body[0] and not changed:
+                changed.append(True)
+                posts[0].body = 'newer'
+                db.session.delete(posts[1])
+                db.session.commit()
+                SearchQueue.drain()
+            return bulk(body)
+        changed = []
+        es.bulk = change_during_rebuild
+        Post.reindex()
+        self.assertEqual(es.indexes['post_v2'][str(posts[0].id)]['body'], 'newer')  # not the copy read before
+        self.assertEqual(sorted(es.indexes['post_v2']), [str(posts[0].id), str(posts[2].id)])
+
+    def test_deep_pages_use_search_after(self):
+        u = User(username='john', email='john@email.com')
+        posts = [Post(body="post {}".format(i), author=u) for i in range(12)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        SearchQueue.drain()
+        es = self.app.elasticsearch
+        bodies = []
+        search = es.search
+        es.search = lambda index, body, **kwargs: bodies.append(dict(body)) or search(index, body, **kwargs)
+        self.app.config['ELASTICSEARCH_TRACK_TOTAL_HITS'] = 5
+        self.app.config['ELASTICSEARCH_MAX_FROM'] = 4
+
+        # only ids come back, and the count stops at the cap but still shows a next page
+        results, total = Post.search('post', 1, 3)
+        self.assertEqual(results.all(), posts[:3])
+        self.assertEqual(total, 5)
+        self.assertIs(bodies[0]['_source'], False)
+        self.assertEqual(bodies[0]['from'], 0)
+        self.assertEqual(bodies[0]['query']['multi_match']['fields'], ['body'])
+
+        # the next page continues after the last hit of the one before
+        results, total = Post.search('post', 2, 3)
+        self.assertEqual(results.all(), posts[3:6])
+        self.assertGreater(total, 6)
+        self.assertEqual(bodies[1]['search_after'], [1.0, posts[2].id])
+        self.assertNotIn('from', bodies[1])
+
+        # a deep page opened directly skips ahead with search_after
+        results, total = Post.search('post', 4, 3)
+        self.assertEqual(results.all(), posts[9:])
+        self.assertEqual([body['size'] for body in bodies[2:]], [4, 4, 1, 4])
+        self.assertEqual(bodies[-1]['search_after'], [1.0, posts[8].id])
+        self.assertEqual(total, 12)  # the last page, so the count is known
+
+class FullTextSearchTest(AppTestCase):
+    # database search engine, used because TestConfig has no ELASTICSEARCH_URL
+
+    def test_search(self):
+        u = User(username='john', email='john@email.com')
+        p1 = Post(body="the quick brown fox", author=u)
+        p2 = Post(body="fox fox fox", author=u)
+        p3 = Post(body="lazy dog", author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        self.assertEqual(Post.search('fox', 1, 10)[1], 0)  # not indexed until the queue is drained
+        SearchQueue.drain()
+
+        results, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(results.all(), [p2, p1])  # best match first
+        self.assertEqual(Post.search('DOG fox', 1, 2)[1], 3)  # terms are OR'ed
+        self.assertEqual(Post.search('"fox AND" NEAR(', 1, 10)[1], 2)  # no query syntax injection
+        self.assertEqual(Post.search('   ', 1, 10)[1], 0)
+
+        db.session.delete(p2)
+        p3.body = 'lazy fox'
+        db.session.commit()
+        SearchQueue.drain()
+        self.assertEqual(Post.search('fox', 1, 10)[0].all(), [p3, p1])
+
+    def test_drain_invalidates_cached_pages_after_commit(self):
+        u = User(username='john', email='john@email.com')
+        p = Post(body="fox", author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        generation = self.app.search_cache.counter('post')
+        bulk_index([('index', 'post', p)])
+        self.assertEqual(self.app.search_cache.counter('post'), generation)  # not visible to searches yet
+        db.session.commit()
+        self.assertEqual(self.app.search_cache.counter('post'), generation + 1)
+
+    def test_reindex_rebuilds_index(self):
+        u = User(username='john', email='john@email.com')
+        db.session.add_all([u] + [Post(body="post {}".format(i), author=u) for i in range(3)])
+        db.session.commit()
+        db.session.query(SearchQueue).delete()  # lose the queued changes
+        db.session.commit()
+        self.assertEqual(Post.search('post', 1, 10)[1], 0)
+        self.assertEqual(Post.reindex(), 3)
+        self.assertEqual(Post.search('post', 1, 10)[1], 3)
+
+class RoutesTest(AppTestCase):
+    def test_explore_cursor_links(self):
+        self.app.config['POSTS_CURSOR_PAGINATION'] = True
+        self.app.config['POSTS_PER_PAGE'] = 2
+        u = self.login('john')
+        now = datetime.utcnow()
+        db.session.add_all([Post(body="post {}".format(i), author=u,
+                                 timestamp=now + timedelta(seconds=i)) for i in range(5)])
+        db.session.commit()
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('post 4', html)
+        self.assertNotIn('post 2', html)
+        self.assertIn('cursor=', html)
+        self.assertNotIn('page=', html)
+        next_url = html.split('<li class="next">')[1].split('href="')[1].split('"')[0]
+        html = self.client.get(next_url.replace('&amp;', '&')).get_data(as_text=True)
+        self.assertIn('post 1', html)
+        self.assertNotIn('post 3', html)
+
+        # page=N links keep working
+        html = self.client.get('/explore?page=2').get_data(as_text=True)
+        self.assertIn('post 1', html)
+        self.assertIn('page=3', html)
+
+    def count_statements(self, url):  # number of SQL statements run to render url
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.session.remove()  # start from an empty identity map like a real request
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return len(statements)
+
+    def test_post_listing_statement_count(self):
+        john = self.login('john')
+        now = datetime.utcnow()
+        db.session.add(Post(body="post from john", author=john, timestamp=now))
+        db.session.commit()
+        urls = ['/index', '/explore', '/user/john']
+        single = [self.count_statements(url) for url in urls]
+
+        # more posts from more authors must not add statements
+        for i in range(5):
+            u = User(username='user{}'.format(i), email='user{}@email.com'.format(i))
+            db.session.add(u)
+            db.session.add(Post(body="post {}".format(i), author=u,
+                                timestamp=now + timedelta(seconds=i + 1)))
+            db.session.add(Post(body="reply {}".format(i), author=john,
+                                timestamp=now + timedelta(seconds=i + 1)))
+            john.follow(u)
+        db.session.commit()
+        self.assertEqual([self.count_statements(url) for url in urls], single)
+
+    def test_post_fragment_cache(self):
+        john = self.login('john')
+        db.session.add(Post(body="cached post", author=john))
+        db.session.commit()
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('cached post', html)
+        self.assertEqual(self.app.fragment_cache.stats()['misses'], 1)
+        self.client.get('/user/john')
+        self.assertEqual(self.app.fragment_cache.stats()['hits'], 1)
+
+        # renaming the author renders the row again
+        self.client.post('/edit_profile', data={'username': 'johnny', 'about_me': ''})
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('/user/johnny', html)
+        self.assertNotIn('/user/john"', html)
+        self.assertEqual(self.app.fragment_cache.stats()['misses'], 2)
+
+        # a changed template renders the row again, old rows expire
+        self.app.fragment_version = 'changed'
+        self.client.get('/explore')
+        self.assertEqual(self.app.fragment_cache.stats()['misses'], 3)
+        self.assertEqual(self.app.fragment_cache.ttl, self.app.config['FRAGMENT_CACHE_TTL'])
+
+    def test_login_rate_limit(self):
+        self.app.config.update(LOGIN_USERNAME_BURST=2, LOGIN_USERNAME_PER_MINUTE=1)
+        self.login('john')
+        self.client.get('/auth/logout')
+        checks = []
+        verify = self.app.passwords.verify
+        self.app.passwords.verify = lambda *args: checks.append(args) or verify(*args)
+        response = self.client.post('/auth/login', data={'username': 'john', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.post('/auth/login', data={'username': 'john', 'password': 'password'})
+        self.assertEqual(response.status_code, 429)  # third attempt for john, the first was in login()
+        self.assertEqual(len(checks), 1)  # rejected before hashing
+        response = self.client.post('/auth/login', data={'username': 'susan', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 302)  # other usernames are not affected
+
+    def test_login_rate_limit_behind_proxy(self):
+        class ProxyConfig(TestConfig):
+            PROXY_FIX_X_FOR = 1
+            LOGIN_ADDRESS_BURST = 1
+            LOGIN_ADDRESS_PER_MINUTE = 1
+        app = create_app(ProxyConfig)
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            for address, status in (('1.2.3.4', 302), ('1.2.3.4', 429), ('5.6.7.8', 302)):
+                response = client.post('/auth/login', data={'username': 'nobody', 'password': 'wrong'},
+                                       headers={'X-Forwarded-For': address})  # all from the same router
+                self.assertEqual(response.status_code, status)
+            db.session.remove()
+
+    def test_login_rate_limit_ignores_unknown_addresses(self):
+        self.app.config.update(LOGIN_ADDRESS_BURST=1, LOGIN_ADDRESS_PER_MINUTE=1)
+        for username in ('john', 'susan'):  # same address, as behind an undeclared proxy
+            response = self.client.post('/auth/login', data={'username': username, 'password': 'wrong'})
+            self.assertEqual(response.status_code, 302)
+        self.app.config['LOGIN_LIMIT_BY_ADDRESS'] = True
+        response = self.client.post('/auth/login', data={'username': 'mary', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.post('/auth/login', data={'username': 'david', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 429)
+
+    def test_explore_from_recent_posts(self):
+        self.app.config.update(POSTS_PER_PAGE=2, RECENT_POSTS_SIZE=3)
+        john = self.login('john')
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=john,
+                                 timestamp=now + timedelta(seconds=i)) for i in range(5)])
+        db.session.commit()
+        self.client.get('/explore')  # loads the buffer
+        post_selects = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT') and 'FROM post' in statement:
+                post_selects.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('post 4', html)
+        self.assertNotIn('post 2', html)
+        self.assertEqual(post_selects, [])
+
+        # committed posts and author changes show up without reloading
+        db.session.add(Post(body='post 5', author=john, timestamp=now + timedelta(seconds=5)))
+        john.username = 'johnny'
+        db.session.commit()
+        html = self.client.get('/explore').get_data(as_text=True)
+        self.assertIn('post 5', html)
+        self.assertIn('johnny', html)
+        self.assertEqual(post_selects, [])
+
+        # pages past the buffer are read from the database
+        html = self.client.get('/explore?page=2').get_data(as_text=True)
+        self.assertIn('post 3', html)
+        self.assertNotIn('post 1', html)
+        self.assertTrue(post_selects)
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    def test_conditional_get(self):
+        john = self.login('john')
+        susan = User(username='susan', email='susan@email.com')
+        db.session.add_all([susan, Post(body='hello', author=john)])
+        db.session.commit()
+        for url in ('/index', '/explore', '/user/john', '/user/susan'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('private', response.headers['Cache-Control'])
+            etag = response.headers['ETag']
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+        explore = self.client.get('/explore')
+        self.assertEqual(self.client.get('/explore', headers={
+            'If-Modified-Since': explore.headers['Last-Modified']}).status_code, 304)
+
+        # a new post, a follow or a pending flash message make the pages render again
+        etags = {url: self.client.get(url).headers['ETag'] for url in ('/index', '/explore', '/user/susan')}
+        self.client.post('/follow/susan')
+        response = self.client.get('/user/susan', headers={'If-None-Match': etags['/user/susan']})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('following susan', response.get_data(as_text=True))  # the flash
+        self.assertNotIn('ETag', response.headers)
+        self.client.post('/index', data={'post': 'another one'})
+        self.client.get('/index')  # shows the flash
+        for url in ('/index', '/explore'):
+            self.assertEqual(self.client.get(url, headers={'If-None-Match': etags[url]}).status_code, 200)
+
+        # so does another author changing their name
+        db.session.add(Post(body='from susan', author=susan))
+        db.session.commit()
+        etags = {url: self.client.get(url).headers['ETag'] for url in ('/index', '/explore')}
+        susan.username = 'susanna'
+        db.session.commit()
+        for url in ('/index', '/explore'):
+            response = self.client.get(url, headers={'If-None-Match': etags[url]})
+            self.assertEqual(response.status_code, 200)
+        self.assertIn('susanna', response.get_data(as_text=True))
+
+    def test_logged_in_user_is_cached(self):
+        self.login('john')
+        db.session.add(User(username='susan', email='susan@email.com'))
+        db.session.commit()
+        user_selects = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT') and 'FROM user' in statement:
+                user_selects.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.client.get('/edit_profile')
+        self.assertEqual(len(user_selects), 1)  # load_user
+        self.client.get('/edit_profile')
+        self.assertEqual(len(user_selects), 1)  # served from the cache
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        # the cached copy is plain JSON data without the password hash, which is
+        # loaded when needed
+        john = User.query.filter_by(username='john').first()
+        cached = self.app.user_cache.get(str(john.id))
+        self.assertEqual(json.loads(json.dumps(cached)), cached)
+        self.assertNotIn('password_hash', cached)
+        db.session.remove()
+        with self.app.test_request_context():
+            self.assertTrue(load_user(str(john.id)).check_password('password'))
+            self.assertEqual(load_user(str(john.id)).last_seen, john.last_seen)
+
+        # commits to the user row and counter updates drop the cached copy
+        self.client.post('/edit_profile', data={'username': 'johnny', 'about_me': 'hi'})
+        self.assertIn('value="johnny"', self.client.get('/edit_profile').get_data(as_text=True))
+        self.client.post('/follow/susan')
+        self.assertIn('0 followers, 1 following', self.client.get('/user/johnny').get_data(as_text=True))
+        susan = User.query.filter_by(username='susan').first()
+        susan.follow_many([User.query.filter_by(username='johnny').first()])  # counters updated in SQL only
+        db.session.commit()
+        self.assertIn('1 followers, 1 following', self.client.get('/user/johnny').get_data(as_text=True))
+
+    def test_last_seen_is_buffered(self):
+        john = self.login('john')
+        john.last_seen = datetime(2020, 1, 1)
+        db.session.commit()
+        writes = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE user'):
+                writes.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.client.get('/explore')
+        self.client.get('/explore')
+        html = self.client.get('/user/john').get_data(as_text=True)
+        self.assertEqual(writes, [])  # nothing written per request
+        self.assertNotIn('2020-01-01', html)  # but the profile shows the buffered value
+
+        # one batched write, and only when the stored value is older than the granularity
+        self.assertEqual(self.app.presence.flush(), 1)
+        db.session.expire_all()
+        self.assertGreater(john.last_seen, datetime(2020, 1, 1))
+        self.client.get('/explore')
+        self.assertEqual(self.app.presence.flush(), 0)
+        john.last_seen -= timedelta(seconds=self.app.config['LAST_SEEN_GRANULARITY'])
+        db.session.commit()
+        self.client.get('/explore')
+        self.assertEqual(self.app.presence.flush(), 1)
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(len(writes), 3)  # two flushes plus the commit above
+
+class InstrumentationTest(AppTestCase):
+    def make_config(self):
+        class InstrumentedConfig(TestConfig):
+            INSTRUMENTATION_ENABLED = True
+            METRICS_ALLOWED_ADDRESSES = ['127.0.0.1']  # the test client's address
+        return InstrumentedConfig
+
+    def test_server_timing_and_metrics(self):
+        self.login('john')
+        response = self.client.get('/explore')
+        timing = response.headers['Server-Timing']
+        for part in ('db;dur=', 'queries', 'search;dur=', 'render;dur=', 'auth;dur=', 'total;dur='):
+            self.assertIn(part, timing)
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_request_seconds_count{route="main.explore"} 1', metrics)
+        self.assertIn('microblog_request_auth_seconds_count{route="auth.login"} 1', metrics)
+        self.assertIn('microblog_request_queries_bucket{route="main.explore",le="+Inf"} 1', metrics)
+        self.assertIn('microblog_search_queue_pending 0', metrics)
+        self.assertNotIn('route="metrics"', metrics)
+
+    def test_metrics_access(self):
+        self.app.config['METRICS_ALLOWED_ADDRESSES'] = Config.METRICS_ALLOWED_ADDRESSES
+        self.assertEqual(self.client.get('/metrics').status_code, 403)  # not even from localhost by default
+        self.app.config.update(METRICS_TOKEN='secret', METRICS_ALLOWED_ADDRESSES=['127.0.0.1'])
+        remote = {'REMOTE_ADDR': '10.1.2.3'}
+        self.assertEqual(self.client.get('/metrics', environ_base=remote).status_code, 403)
+        self.assertEqual(self.client.get('/metrics', environ_base=remote, headers={
+            'Authorization': 'Bearer wrong'}).status_code, 403)
+        self.assertEqual(self.client.get('/metrics', environ_base=remote, headers={
+            'Authorization': 'Bearer secret'}).status_code, 200)
+
+        # the queue gauges are read once per METRICS_QUEUE_TTL
+        db.session.add(SearchQueue(index='post', object_id=1, action='index'))
+        db.session.commit()
+        self.assertIn('microblog_search_queue_pending 0', self.client.get('/metrics').get_data(as_text=True))
+        self.app.instrumentation.queue_depth = (0, None)
+        metrics = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_search_queue_pending 1', metrics)
+        self.assertIn('microblog_search_queue_oldest_age', metrics)
+
+class ReplicaTest(AppTestCase):
+    # SQLite files, the replicas are brought up to date by copying the primary
+    def make_config(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.primary = os.path.join(self.tmp.name, 'primary.db')
+        self.replicas = [os.path.join(self.tmp.name, 'replica{}.db'.format(i)) for i in range(2)]
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.primary
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + replica for replica in self.replicas]
+            USER_CACHE_TTL = 0
+        return ReplicaConfig
+
+    def setUp(self):
+        super().setUp()
+        john = User(username='john', email='john@example.com')
+        john.set_password('password')
+        db.session.add(john)
+        db.session.commit()
+        self.replicate()
+
+    def tearDown(self):
+        super().tearDown()
+        db.get_engine(self.app).dispose()
+        for i in range(len(self.replicas)):
+            db.get_engine(self.app, bind='replica_{}'.format(i)).dispose()
+        self.tmp.cleanup()
+
+    def replicate(self):
+        for replica in self.replicas:
+            shutil.copy(self.primary, replica)
+
+    def test_reads_use_replica_until_user_writes(self):
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'password'})
+        db.session.add(Post(body='not replicated yet', author=User.query.first()))
+        db.session.commit()
+        html = self.client.get('/user/john').get_data(as_text=True)
+        self.assertNotIn('not replicated yet', html)  # read from the replica
+
+        response = self.client.post('/index', data={'post': 'my own post'})
+        self.assertIn('db_primary_until', response.headers['Set-Cookie'])
+        html = self.client.get('/user/john').get_data(as_text=True)
+        self.assertIn('my own post', html)  # read back from the primary
+        self.assertIn('not replicated yet', html)
+
+        self.client.cookie_jar.clear()
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'password'})
+        html = self.client.get('/user/john').get_data(as_text=True)
+        self.assertNotIn('my own post', html)  # the cookie expired, back to the replica
+        self.replicate()
+        self.assertIn('my own post', self.client.get('/user/john').get_data(as_text=True))
+
+    def test_one_replica_per_request(self):
+        used = []
+        for i in range(len(self.replicas)):
+            db.event.listen(db.get_engine(self.app, bind='replica_{}'.format(i)), 'before_cursor_execute',
+                            lambda *args, i=i: used.append(i))
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'password'})
+        seen = []
+        for _ in range(2):
+            del used[:]
+            self.client.get('/user/john?page=1')  # page rows and the pagination count
+            self.assertGreater(len(used), 1)
+            self.assertEqual(len(set(used)), 1)
+            seen.append(used[0])
+        self.assertEqual(sorted(seen), [0, 1])  # requests still take turns
+
+class SQLiteTunedTest(AppTestCase):
+    def make_config(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'tuned.db')
+        class TunedConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+            SQLITE_TUNED = True
+        return TunedConfig
+
+    def tearDown(self):
+        super().tearDown()
+        db.get_engine(self.app).dispose()
+        self.tmp.cleanup()
+
+    def test_pragmas(self):
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.session.execute('PRAGMA synchronous').scalar(), 1)  # NORMAL
+        self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), 5000)
+
+    def test_writes_hold_the_writer_lock_until_commit(self):
+        def lock_is_free():  # asked from another thread, the lock is reentrant
+            result = []
+            def check():
+                result.append(writer_lock.acquire(blocking=False))
+                if result[0]:
+                    writer_lock.release()
+            thread = threading.Thread(target=check)
+            thread.start()
+            thread.join()
+            return result[0]
+        User.query.all()
+        self.assertTrue(lock_is_free())  # reads don't take it
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.flush()
+        self.assertFalse(lock_is_free())
+        db.session.commit()
+        self.assertTrue(lock_is_free())
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertTrue(lock_is_free())
+
+class LoggingTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.app.config.update(LOG_DIR=self.log_dir.name, LOG_ROTATE_BYTES=2000, LOG_COMPRESS=True)
+
+    def tearDown(self):
+        super().tearDown()
+        self.log_dir.cleanup()
+
+    def test_json_lines_with_request_context(self):
+        pipeline = LogPipeline(self.app)
+        with self.app.test_request_context('/explore', headers={'X-Request-ID': 'abc123'}):
+            self.app.logger.info('hello %s', 'world', extra={'fields': {'queries': 3}})
+            self.assertFalse(hasattr(_request_ctx_stack.top, 'user'))  # logging didn't load the user
+            _request_ctx_stack.top.user = User(id=7)  # loaded by Flask-Login
+            self.app.logger.info('logged in')
+            for i in range(50):
+                self.app.logger.info('filler line %d', i)
+        pipeline.stop()
+        with open(os.path.join(self.log_dir.name, 'microblog.log')) as f:
+            lines = [json.loads(line) for line in f]
+        rotated = sorted(name for name in os.listdir(self.log_dir.name) if name.endswith('.gz'))
+        self.assertTrue(rotated)  # rotated files are gzipped
+        with gzip.open(os.path.join(self.log_dir.name, rotated[-1]), 'rt') as f:
+            lines = [json.loads(line) for line in f] + lines
+        self.assertEqual(lines[0]['message'], 'hello world')
+        self.assertEqual(lines[0]['request_id'], 'abc123')
+        self.assertEqual(lines[0]['queries'], 3)
+        self.assertIsNone(lines[0]['user_id'])
+        self.assertEqual(lines[1]['user_id'], 7)
+
+    def test_error_mails_are_batched(self):
+        sent = []
+        class RecordingHandler(BatchingSMTPHandler):
+            def send(self, message):
+                sent.append(message)
+        handler = RecordingHandler('localhost', 25, 'from@example.com', ['to@example.com'],
+                                   'Failure', interval=60, max_records=2)
+        logger = logging.getLogger('test_error_mails')
+        logger.addHandler(handler)
+        for i in range(5):
+            logger.error('error %d', i)
+        self.assertEqual(len(sent), 1)  # the first error goes out right away, the rest wait
+        handler.close()
+        logger.removeHandler(handler)
+        self.assertEqual(len(sent), 2)
+        self.assertIn('(4 errors)', sent[1]['Subject'])
+        self.assertIn('2 more errors', sent[1].get_content())
+
+class SMTPStandIn(socketserver.StreamRequestHandler):  # just enough SMTP for smtplib.sendmail
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b'220 localhost\r\n')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                data = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                if self.server.failures:
+                    self.server.failures -= 1
+                    self.wfile.write(b'451 try again later\r\n')
+                else:
+                    self.server.messages.append(b''.join(data))
+                    self.wfile.write(b'250 queued\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                break
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+class MailQueueTest(AppTestCase):
+    def make_config(self):
+        self.smtp = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStandIn)
+        self.smtp.daemon_threads = True
+        self.smtp.connections, self.smtp.messages, self.smtp.failures = 0, [], 0
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = self.smtp.server_address[1]
+            MAIL_SUPPRESS_SEND = False
+            MAIL_WORKERS = 1
+            MAIL_RETRY_BACKOFF = 0.01
+        return MailConfig
+
+    def tearDown(self):
+        super().tearDown()
+        self.smtp.shutdown()
+        self.smtp.server_close()
+
+    def send(self, count):
+        for i in range(count):
+            self.assertTrue(send_email('message {}'.format(i), 'from@example.com',
+                                       ['to@example.com'], 'text', '<p>html</p>'))
+
+    def test_messages_share_a_connection_and_drain_at_stop(self):
+        self.send(20)
+        self.app.mailer.stop()
+        self.assertEqual(len(self.smtp.messages), 20)
+        self.assertEqual(self.app.mailer.sent, 20)
+        self.assertEqual(self.smtp.connections, 1)  # the queue never went idle long enough to reconnect
+
+    def test_failed_messages_are_retried(self):
+        self.smtp.failures = 2
+        self.send(3)
+        self.app.mailer.stop()
+        self.assertEqual(len(self.smtp.messages), 3)
+        self.assertEqual(self.app.mailer.failed, 0)
+
+    def test_sent_on_the_calling_thread_without_workers(self):
+        self.app.mailer.stop()  # like MAIL_WORKERS=0, or mail sent after shutdown began
+        self.send(1)
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.smtp.failures = 1
+        self.assertFalse(send_email('refused', 'from@example.com', ['to@example.com'], 'text', 'html'))
+        self.assertEqual(self.app.mailer.failed, 1)
+
+        # a failed reset mail doesn't fail the request
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.smtp.failures = 1
+        response = self.client.post('/auth/reset_password_request', data={'email': 'john@example.com'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.app.mailer.failed, 2)
+
+    def test_full_queue_rejects(self):
+        self.app.mailer.queue.maxsize = 1
+        self.app.config['MAIL_QUEUE_TIMEOUT'] = 0.01
+        self.app.mailer.workers.append(None)  # pretend the pool is running but stuck
+        self.send(1)
+        self.assertFalse(send_email('too many', 'from@example.com', ['to@example.com'], 'text', 'html'))
+        self.app.mailer.workers = []
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)  # runs all tests